@@ -0,0 +1,237 @@
+import asyncio
+import contextlib
+import datetime
+import time
+import traceback
+from aiobotocore.config import AioConfig
+from aiobotocore.session import AioSession
+from clients import client_options
+from instrumentation import detector_context, observe_phase, register_instrumentation
+from result_sink import current_target, write_orphans
+from metric_cache import metric_cache
+from metric_data import build_metric_data_requests, collect_metric_data
+from orchestrator import PhaseResult
+from query_planner import aggregate_queries, metric_window_align, scan_window
+from rate_limit import register_rate_limiter
+from scan_state import split_changed, record_verdicts
+import ec2
+import eip
+import elb
+import rds
+import volumes
+
+
+# Asyncio alternative to the threaded detectors. Describe pages and
+# GetMetricData requests are issued concurrently on one event loop, bounded
+# by a semaphore, and every page is judged by the detectors' own
+# evaluate_*_page functions so the verdicts match the blocking scan.
+
+def flatten_reservations(reservations):
+    return [instance for reservation in reservations for instance in reservation['Instances']]
+
+
+# name -> (service, operation, result key, id key, query builder,
+#          metrics builder, page evaluator)
+metric_detectors = {
+    'EC2': ('ec2', 'describe_instances', 'Reservations', 'InstanceId',
+            ec2.build_ec2_queries, ec2.build_ec2_metrics, ec2.evaluate_ec2_page),
+    'Volume': ('ec2', 'describe_volumes', 'Volumes', 'VolumeId',
+               volumes.build_volume_queries, volumes.build_volume_metrics, volumes.evaluate_volume_page),
+    'ELB': ('elbv2', 'describe_load_balancers', 'LoadBalancers', 'LoadBalancerArn',
+            elb.build_elb_queries, elb.build_elb_metrics, elb.evaluate_load_balancer_page),
+    'RDS': ('rds', 'describe_db_instances', 'DBInstances', 'DBInstanceIdentifier',
+            rds.build_db_queries, rds.build_db_metrics, rds.evaluate_rds_page),
+}
+
+
+async def get_metric_data_async(cloudwatch, queries, start_time, end_time, semaphore):
+    # The window is the scan's, so both engines read and store the same entries
+    cached = dict()
+    if metric_cache and queries:
+        cached, queries = metric_cache.lookup(queries, start_time, end_time)
+    results = {key: [] for key in queries}
+
+    async def fetch(ids, kwargs):
+        while True:
+            async with semaphore:
+                response = await cloudwatch.get_metric_data(**kwargs)
+            collect_metric_data(results, ids, response)
+
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+            kwargs['NextToken'] = next_token
+
+    await asyncio.gather(*(
+        fetch(ids, kwargs) for ids, kwargs in build_metric_data_requests(queries, start_time, end_time)
+    ))
+    if metric_cache and queries:
+        expires_at = end_time.replace(tzinfo=datetime.timezone.utc).timestamp() + metric_window_align
+        metric_cache.store(queries, results, start_time, end_time, expires_at)
+
+    results.update(cached)
+    return results
+
+
+async def iter_pages_async(client, operation, result_key, semaphore):
+    pages = client.get_paginator(operation).paginate().__aiter__()
+    while True:
+        # Each page is its own request, so each one takes a semaphore slot
+        async with semaphore:
+            try:
+                page = await pages.__anext__()
+            except StopAsyncIteration:
+                break
+        yield page.get(result_key, [])
+
+
+async def evaluate_page_async(name, resources, cloudwatch, window, semaphore):
+    service, operation, result_key, id_key, build_queries, build_metrics, evaluate = metric_detectors[name]
+
+    # Only new, changed or stale resources are evaluated in incremental mode
+    resources, known_orphans = split_changed(name, resources)
+
+    ids = [resource[id_key] for resource in resources]
+    start_time, end_time = window
+    queries = aggregate_queries(build_queries(ids), start_time, end_time)
+    results = await get_metric_data_async(cloudwatch, queries, start_time, end_time, semaphore)
+
+    page_orphans = evaluate(resources, build_metrics(ids, results))
+    record_verdicts(name, resources, page_orphans)
+    page_orphans = set(page_orphans).union(known_orphans)
+    write_orphans(page_orphans)
+    return page_orphans
+
+
+async def detect_async(name, pages, cloudwatch, window, semaphore):
+    # Metrics of every page are fetched while later pages are still being described
+    tasks = []
+    async for resources in pages:
+        tasks.append(asyncio.create_task(evaluate_page_async(name, resources, cloudwatch, window, semaphore)))
+
+    orphans = set()
+    for page_orphans in await asyncio.gather(*tasks):
+        orphans.update(page_orphans)
+    return orphans
+
+
+async def iter_instance_pages_async(ec2_client, semaphore):
+    async for reservations in iter_pages_async(ec2_client, 'describe_instances', 'Reservations', semaphore):
+        yield flatten_reservations(reservations)
+
+
+class AsyncPageCache:
+    # asyncio counterpart of inventory.PageCache. Each consumer replays the
+    # pages already described and then describes the next one itself, or
+    # waits on the lock for the consumer describing it, so the EC2 and EIP
+    # detectors both start on the first page without waiting for the last
+
+    def __init__(self, source):
+        self.source = source
+        self.pages = []
+        self.done = False
+        self.error = None
+        self.lock = asyncio.Lock()
+
+    async def __aiter__(self):
+        index = 0
+        while True:
+            if index >= len(self.pages) and not self.done:
+                async with self.lock:
+                    if self.error:
+                        raise self.error
+                    if index >= len(self.pages) and not self.done:
+                        try:
+                            self.pages.append(await self.source.__anext__())
+                        except StopAsyncIteration:
+                            self.done = True
+                        except Exception as e:
+                            # A failed generator cannot be resumed, every consumer sees the error
+                            self.error = e
+                            raise
+            if index >= len(self.pages):
+                return
+            yield self.pages[index]
+            index += 1
+
+
+async def timed(name, coroutine):
+    start = time.perf_counter()
+    try:
+        # gather runs every phase in its own task, so the name stays with it
+        with detector_context(name):
+            result = await coroutine
+        error = None
+    except Exception as e:
+        print("\n{} detector failed:".format(name))
+        traceback.print_exception(e)
+        result = set()
+        error = e
+    elapsed = time.perf_counter() - start
+    observe_phase(name, elapsed)
+
+    print("\n{} detector finished in {:.2f}s".format(name, elapsed))
+    return PhaseResult(name, result, error, elapsed)
+
+
+async def scan_async(region_name, profile=None, names=None, concurrency=64, endpoint_url=None):
+    names = names or ['EIP'] + list(metric_detectors)
+    semaphore = asyncio.Semaphore(concurrency)
+    session = AioSession(profile=profile)
+    # The pool has to hold every request the semaphore lets through, or
+    # aiohttp queues them behind its default of 10 connections
+    client_config = AioConfig(**dict(client_options, max_pool_connections=concurrency))
+
+    async with contextlib.AsyncExitStack() as stack:
+        clients = dict()
+        for service in ['ec2', 'rds', 'elbv2', 'cloudwatch', 'sts']:
+            clients[service] = await stack.enter_async_context(
+                session.create_client(service, region_name=region_name, endpoint_url=endpoint_url, config=client_config)
+            )
+            register_rate_limiter(clients[service], profile, region_name, asynchronous=True)
+            register_instrumentation(clients[service])
+
+        identity = await clients['sts'].get_caller_identity()
+        # Tasks copy the context, so every row written is stamped with the target
+        current_target.set((identity['Account'], region_name))
+        eip.region_metric.labels(aws_region=region_name).set(1)
+
+        # Instances are described once, page by page, and shared by the EC2
+        # and EIP detectors
+        instance_pages = AsyncPageCache(iter_instance_pages_async(clients['ec2'], semaphore))
+
+        # Every detector of the scan queries the same window
+        window = scan_window()
+        phases = dict()
+        for name in names:
+            if name == 'EIP':
+                phases[name] = timed(name, detect_eips_async(instance_pages, clients['ec2'], semaphore))
+                continue
+
+            service, operation, result_key = metric_detectors[name][:3]
+            if name == 'EC2':
+                pages = instance_pages
+            else:
+                pages = iter_pages_async(clients[service], operation, result_key, semaphore)
+            phases[name] = timed(name, detect_async(name, pages, clients['cloudwatch'], window, semaphore))
+
+        results = await asyncio.gather(*phases.values())
+        return identity['Account'], dict(zip(phases, results))
+
+
+async def detect_eips_async(instance_pages, ec2_client, semaphore):
+    associated_eips = set()
+    async for instances in instance_pages:
+        associated_eips.update(eip.get_associated_eips(instances))
+
+    # describe_addresses is not paginated, it always returns every address
+    async with semaphore:
+        response = await ec2_client.describe_addresses()
+
+    orphaned_eips = eip.evaluate_eip_page(response.get('Addresses', []), associated_eips)
+    write_orphans(orphaned_eips)
+    return orphaned_eips
+
+
+def scan(region_name, profile=None, names=None, concurrency=64, endpoint_url=None):
+    return asyncio.run(scan_async(region_name, profile, names, concurrency, endpoint_url))
@@ -0,0 +1,405 @@
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from botocore.awsrequest import AWSResponse
+
+
+# Offline benchmark of the detectors against a synthetic fleet. Every AWS call
+# is answered in process by FakeAWS from botocore's before-call event, so no
+# request leaves the machine. The real paginators, parameter validation and
+# detector code run, but answering at before-call skips everything from
+# before-send on: the rate limiter, retries and the per attempt and bytes
+# instrumentation never run, and --latency stands in for the whole round trip.
+# Each phase runs in a process of its own, so its peak RSS is its own.
+#
+#   python benchmark.py --instances 10000 --latency 20 --output bench.json
+#   python benchmark.py --instances 10000 --compare bench.json
+
+account_id = '123456789012'
+
+
+def stable_fraction(*parts):
+    # Deterministic pseudo random number in [0, 1) for a resource and metric
+    return zlib.crc32(':'.join(parts).encode()) / 2 ** 32
+
+
+class Fleet:
+    # Synthetic estate. Roughly the given orphan_ratio of every resource type
+    # looks idle, unattached or unhealthy to the detectors
+
+    def __init__(self, region, instances, volumes, databases, load_balancers, addresses, orphan_ratio=0.2):
+        self.region = region
+        self.orphan_ratio = orphan_ratio
+        created = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+        self.instances = [{
+            'InstanceId': 'i-{:017x}'.format(index),
+            'InstanceType': 't3.micro',
+            'State': {'Name': 'running'},
+            'Tags': [{'Key': 'Name', 'Value': 'bench-{}'.format(index)}],
+            'BlockDeviceMappings': [],
+            'PublicIpAddress': '10.{}.{}.{}'.format(index >> 16 & 255, index >> 8 & 255, index & 255),
+        } for index in range(instances)]
+
+        self.volumes = []
+        for index in range(volumes):
+            volume_id = 'vol-{:017x}'.format(index)
+            attached = stable_fraction(volume_id, 'attached') >= orphan_ratio and index < instances
+            self.volumes.append({
+                'VolumeId': volume_id,
+                'Size': 8,
+                'VolumeType': 'gp3',
+                'CreateTime': created,
+                'State': 'in-use' if attached else 'available',
+                'Attachments': [{
+                    'InstanceId': self.instances[index]['InstanceId'], 'State': 'attached', 'AttachTime': created
+                }] if attached else [],
+                'Tags': [{'Key': 'Name', 'Value': 'bench-{}'.format(index)}],
+            })
+
+        # Young enough to pass the age rule, so only idle databases are orphans
+        launched = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=7)
+        self.databases = [{
+            'DBInstanceIdentifier': 'db-{}'.format(index),
+            'DBInstanceArn': 'arn:aws:rds:{}:{}:db:db-{}'.format(region, account_id, index),
+            'DBInstanceStatus': 'available',
+            'DBInstanceClass': 'db.t3.micro',
+            'InstanceCreateTime': launched,
+            'TagList': [{'Key': 'Project', 'Value': 'bench'}, {'Key': 'Environment', 'Value': 'bench'}],
+        } for index in range(databases)]
+
+        self.load_balancers = [{
+            'LoadBalancerArn': 'arn:aws:elasticloadbalancing:{}:{}:loadbalancer/app/bench-{}/{:016x}'.format(
+                region, account_id, index, index),
+            'State': {'Code': 'active'},
+            'AvailabilityZones': [],
+            'SecurityGroups': [],
+        } for index in range(load_balancers)]
+
+        # The first addresses belong to instances, the rest are unassociated
+        associated = int(addresses * (1 - orphan_ratio))
+        self.addresses = [{
+            'PublicIp': self.instances[index]['PublicIpAddress'] if index < min(associated, instances)
+            else '172.{}.{}.{}'.format(index >> 16 & 255, index >> 8 & 255, index & 255),
+            'AllocationId': 'eipalloc-{:017x}'.format(index),
+        } for index in range(addresses)]
+
+    def size(self):
+        return len(self.instances) + len(self.volumes) + len(self.databases) + len(self.load_balancers) + len(self.addresses)
+
+    def metric_values(self, resource_id, metric_name, datapoints=3):
+        # Idle resources report zeros, busy ones something above every
+        # threshold, and no failed status checks
+        if stable_fraction(resource_id, 'idle') < self.orphan_ratio:
+            return [0.0] * datapoints
+        if metric_name.startswith('StatusCheckFailed'):
+            return [0.0] * datapoints
+        value = 1e12 * (1 + stable_fraction(resource_id, metric_name))
+        return [value] * datapoints
+
+
+def paginate(items, params, token_key, size_key, default_size, result_key, next_key=None):
+    # Serves a slice of items, with a numeric offset as the continuation token
+    offset = int(params.get(token_key) or 0)
+    size = params.get(size_key) or default_size
+    response = {result_key: items[offset:offset + size]}
+    if offset + size < len(items):
+        response[next_key or token_key] = str(offset + size)
+    return response
+
+
+class FakeAWS:
+    # Answers every call of the clients created from a session, counts the
+    # calls by operation and sleeps latency (+ jitter) seconds per call
+
+    def __init__(self, fleet, latency=0.0, jitter=0.0):
+        self.fleet = fleet
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = collections.Counter()
+        # GetMetricData is billed per metric queried, not per call
+        self.metric_queries = 0
+        self.metric_datapoints = 0
+        self.lock = threading.Lock()
+
+    def install(self, session):
+        session.events.register('before-parameter-build', self.remember_params)
+        session.events.register('before-call', self.respond)
+
+    def remember_params(self, params, context, **kwargs):
+        # before-call only sees the serialised request, so keep the parameters
+        context['benchmark_params'] = params
+
+    def respond(self, model, context, **kwargs):
+        operation = '{}.{}'.format(model.service_model.service_name, model.name)
+        with self.lock:
+            self.calls[operation] += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        handler = getattr(self, model.service_model.service_name.replace('-', '_') + '_' + model.name, None)
+        if handler is None:
+            raise NotImplementedError('FakeAWS does not answer {}'.format(operation))
+        parsed = handler(context.get('benchmark_params', {}))
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RequestId': 'benchmark'}
+        return AWSResponse('https://benchmark.invalid', 200, {}, None), parsed
+
+    def sts_GetCallerIdentity(self, params):
+        return {'Account': account_id, 'Arn': 'arn:aws:iam::{}:user/benchmark'.format(account_id), 'UserId': 'benchmark'}
+
+    def ec2_DescribeInstances(self, params):
+        response = paginate(self.fleet.instances, params, 'NextToken', 'MaxResults', 1000, 'Instances')
+        response['Reservations'] = [{'Instances': response.pop('Instances')}]
+        return response
+
+    def ec2_DescribeVolumes(self, params):
+        return paginate(self.fleet.volumes, params, 'NextToken', 'MaxResults', 500, 'Volumes')
+
+    def ec2_DescribeAddresses(self, params):
+        return {'Addresses': self.fleet.addresses}
+
+    def rds_DescribeDBInstances(self, params):
+        return paginate(self.fleet.databases, params, 'Marker', 'MaxRecords', 100, 'DBInstances')
+
+    def elbv2_DescribeLoadBalancers(self, params):
+        return paginate(self.fleet.load_balancers, params, 'Marker', 'PageSize', 400, 'LoadBalancers', 'NextMarker')
+
+    def cloudwatch_GetMetricData(self, params):
+        end_time = params.get('EndTime') or datetime.datetime.utcnow()
+        start_time = params.get('StartTime') or end_time - datetime.timedelta(days=1)
+        window = (end_time - start_time).total_seconds()
+        results = []
+        for query in params['MetricDataQueries']:
+            if 'Expression' in query:
+                results.extend(self.metrics_insights_results(query, end_time, window))
+                continue
+            # One datapoint per period of the window
+            period = query['MetricStat']['Period']
+            metric = query['MetricStat']['Metric']
+            values = self.fleet.metric_values(metric['Dimensions'][0]['Value'], metric['MetricName'], max(1, int(window // period)))
+            results.append({
+                'Id': query['Id'],
+                'Label': metric['MetricName'],
+                'StatusCode': 'Complete',
+                'Timestamps': [end_time - datetime.timedelta(seconds=period * index) for index in range(len(values))],
+                'Values': values,
+            })
+        with self.lock:
+            self.metric_queries += len(params['MetricDataQueries'])
+            self.metric_datapoints += sum(len(result['Values']) for result in results)
+        return {'MetricDataResults': results}
+
+    def metrics_insights_results(self, query, end_time, window):
+        # A grouped SELECT answers one series per resource, up to its LIMIT
+        match = re.match(r'SELECT \w+\("?([^"]+?)"?\) FROM SCHEMA\("[^"]+", "?(\w+)"?\) GROUP BY \S+ LIMIT (\d+)$', query['Expression'])
+        metric_name, dimension_name, limit = match.group(1), match.group(2), int(match.group(3))
+        resources, id_key = {
+            'InstanceId': (self.fleet.instances, 'InstanceId'),
+            'VolumeId': (self.fleet.volumes, 'VolumeId'),
+            'DBInstanceIdentifier': (self.fleet.databases, 'DBInstanceIdentifier'),
+        }[dimension_name]
+        period = query['Period']
+        datapoints = max(1, int(window // period))
+        return [{
+            'Id': query['Id'],
+            'Label': resource[id_key],
+            'StatusCode': 'Complete',
+            'Timestamps': [end_time - datetime.timedelta(seconds=period * index) for index in range(datapoints)],
+            'Values': self.fleet.metric_values(resource[id_key], metric_name, datapoints),
+        } for resource in resources[:limit]]
+
+
+def peak_rss_mb():
+    # Peak of the whole process, which only runs one phase. ru_maxrss is in
+    # kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Resources each detector walks, for results per second
+detector_collections = {
+    'EIP': ['instances', 'addresses'],
+    'EC2': ['instances'],
+    'Volume': ['volumes'],
+    'ELB': ['load_balancers'],
+    'RDS': ['databases'],
+}
+
+
+def measure(fake, name, run, resources):
+    fake.calls.clear()
+    fake.metric_queries = 0
+    fake.metric_datapoints = 0
+    start = time.perf_counter()
+    orphans = run()
+    elapsed = time.perf_counter() - start
+    return {
+        'name': name,
+        'wall_seconds': round(elapsed, 3),
+        'resources': resources,
+        'resources_per_second': round(resources / elapsed, 1) if elapsed else None,
+        'orphans': orphans,
+        'api_calls': sum(fake.calls.values()),
+        'api_calls_by_operation': dict(sorted(fake.calls.items())),
+        'metric_queries': fake.metric_queries,
+        'metric_datapoints': fake.metric_datapoints,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# Name of the phase running every detector
+full_scan_phase = 'identify_orphaned_resources'
+
+
+def run_phase(args, name):
+    # Runs one detector, or the full scan, in this process
+    fleet = Fleet(args.region, args.instances, args.volumes, args.databases, args.load_balancers, args.addresses, args.orphan_ratio)
+    fake = FakeAWS(fleet, args.latency / 1000.0, args.jitter / 1000.0)
+
+    # The fake has to be on the session before any client is created
+    import clients
+    fake.install(clients.get_session(None))
+
+    import identify_orphaned_resources
+    import result_sink
+    from config import load_config
+    from fanout import Target
+    from inventory import InventorySnapshot
+    from orchestrator import run_detector
+
+    # Keep the benchmark's reports out of the working directory
+    output_dir = tempfile.mkdtemp(prefix='orphan-benchmark-')
+    runner = identify_orphaned_resources.ScanRunner(load_config())
+    result_sink.orphan_sink.base_path = os.path.join(output_dir, 'orphaned')
+    runner.excel_report = os.path.join(output_dir, 'orphaned_resources.xlsx')
+    runner.targets = [Target(None, args.region)]
+
+    detectors = identify_orphaned_resources.load_detectors()
+    if name == full_scan_phase:
+        # The whole flow of one scheduled run: every detector, sinks, exporter and workbook
+        def full_scan():
+            target_results = runner.run_scan(detectors)
+            return sum(len(phase.result) for target_result in target_results for phase in target_result.phases.values())
+        return measure(fake, name, full_scan, fleet.size())
+
+    snapshot = InventorySnapshot(args.region)
+    resources = sum(len(getattr(fleet, collection)) for collection in detector_collections[name])
+    return measure(fake, name, lambda: len(run_detector(name, detectors[name], snapshot).result), resources)
+
+
+def run_benchmark(args, argv):
+    # Every phase runs in a child process started with the same arguments
+    names = args.detectors or list(detector_collections) + [full_scan_phase]
+    phases = []
+
+    for name in names:
+        with tempfile.NamedTemporaryFile(suffix='.json') as phase_file:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__)] + argv + ['--phase', name, '--phase-output', phase_file.name],
+                check=True
+            )
+            phase = json.load(phase_file)
+        phases.append(phase)
+        label = 'Full scan' if name == full_scan_phase else name
+        print("\n{}: {wall_seconds}s, {api_calls} calls, {metric_queries} metric queries, {metric_datapoints} datapoints, {resources_per_second} resources/s, {orphans} orphans, {peak_rss_mb} MB peak RSS".format(label, **phase))
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fleet': {
+            'instances': args.instances,
+            'volumes': args.volumes,
+            'databases': args.databases,
+            'load_balancers': args.load_balancers,
+            'addresses': args.addresses,
+            'orphan_ratio': args.orphan_ratio,
+        },
+        'latency_ms': args.latency,
+        'jitter_ms': args.jitter,
+        'phases': phases,
+    }
+
+
+def compare(results, baseline):
+    # Prints every phase's wall time and API calls against a previous run
+    previous = {phase['name']: phase for phase in baseline['phases']}
+    print("\nCompared with {} ({}):".format(baseline.get('commit'), baseline.get('timestamp')))
+    for phase in results['phases']:
+        old = previous.get(phase['name'])
+        if not old:
+            continue
+        ratio = phase['wall_seconds'] / old['wall_seconds'] if old['wall_seconds'] else float('nan')
+        print("  {:<28} {:>8.3f}s -> {:>8.3f}s ({:.2f}x)  calls {} -> {}  metric queries {} -> {}".format(
+            phase['name'], old['wall_seconds'], phase['wall_seconds'], ratio, old['api_calls'], phase['api_calls'],
+            old.get('metric_queries'), phase['metric_queries']))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the orphan detectors against a synthetic, in-process AWS fleet.')
+    parser.add_argument('--instances', type=int, default=1000)
+    parser.add_argument('--volumes', type=int, help='defaults to the number of instances')
+    parser.add_argument('--databases', type=int, help='defaults to a tenth of the instances')
+    parser.add_argument('--load-balancers', type=int, help='defaults to a tenth of the instances')
+    parser.add_argument('--addresses', type=int, help='defaults to a tenth of the instances')
+    parser.add_argument('--orphan-ratio', type=float, default=0.2)
+    parser.add_argument('--latency', type=float, default=0, help='simulated milliseconds per API call')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra milliseconds per API call')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--detectors', nargs='+', help='only run these detectors, and skip the full scan')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    # Set by the parent process on the child running a single phase
+    parser.add_argument('--phase', help=argparse.SUPPRESS)
+    parser.add_argument('--phase-output', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    for option in ['databases', 'load_balancers', 'addresses']:
+        if getattr(args, option) is None:
+            setattr(args, option, max(1, args.instances // 10))
+    if args.volumes is None:
+        args.volumes = args.instances
+    return args
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    # Fake credentials, nothing is ever sent
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', args.region)
+
+    if args.phase:
+        with open(args.phase_output, 'w') as phase_file:
+            json.dump(run_phase(args, args.phase), phase_file)
+        sys.exit()
+
+    results = run_benchmark(args, argv)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print("\nWrote results to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
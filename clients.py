@@ -0,0 +1,54 @@
+import boto3
+import threading
+from config import load_config
+from botocore.config import Config
+from instrumentation import register_instrumentation
+from rate_limit import register_rate_limiter
+
+
+# Load the config file
+config = load_config()
+
+region_name = config['region_name']
+endpoint_url = config.get('endpoint_url')
+
+# One botocore config shared by every client: a connection pool large enough
+# for the detector threads, keep-alive sockets and throttling aware retries.
+# The asyncio engine builds its clients' config from the same options
+client_options = dict(
+    max_pool_connections=config.get('max_pool_connections', 50),
+    tcp_keepalive=config.get('tcp_keepalive', True),
+    retries={
+        'max_attempts': config.get('max_retry_attempts', 5),
+        'mode': config.get('retry_mode', 'standard')
+    }
+)
+client_config = Config(**client_options)
+
+# Sessions are keyed by profile and clients by (profile, region, service), so
+# credentials and endpoints are resolved once and TLS connections are reused
+sessions = dict()
+clients = dict()
+clients_lock = threading.Lock()
+
+
+def get_session(profile=None):
+    with clients_lock:
+        if profile not in sessions:
+            sessions[profile] = boto3.Session(profile_name=profile)
+        return sessions[profile]
+
+
+def get_client(service, profile=None, region=None):
+    region = region or region_name
+    key = (profile, region, service)
+
+    # Client creation on a shared session is not thread safe, so it is locked
+    session = get_session(profile)
+    with clients_lock:
+        if key not in clients:
+            client = session.client(service, region_name=region, endpoint_url=endpoint_url, config=client_config)
+            register_rate_limiter(client, profile, region)
+            register_instrumentation(client)
+            clients[key] = client
+        return clients[key]
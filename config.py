@@ -0,0 +1,27 @@
+import os
+import threading
+import yaml
+
+
+# config.yml is parsed once per process and shared by every module. The first
+# call decides which file is read: the CLI passes --config before anything
+# else is imported, otherwise ORPHANS_CONFIG or config.yml in the working
+# directory is used.
+
+default_config_path = os.environ.get('ORPHANS_CONFIG', 'config.yml')
+
+loaded_config = None
+loaded_config_path = None
+config_lock = threading.Lock()
+
+
+def load_config(path=None):
+    global loaded_config, loaded_config_path
+    with config_lock:
+        if loaded_config is None:
+            loaded_config_path = path or default_config_path
+            with open(loaded_config_path, 'r') as config_file:
+                loaded_config = yaml.safe_load(config_file) or dict()
+        elif path and os.path.abspath(path) != os.path.abspath(loaded_config_path):
+            raise RuntimeError("Config already loaded from {}, cannot switch to {}".format(loaded_config_path, path))
+        return loaded_config
@@ -1,14 +1,18 @@
-import boto3
-import datetime
-import yaml
+from clients import get_client
+from config import load_config
 import time
-from add_to_csv import add_to_csv
-from prometheus_client import Gauge
+from records import orphan_record
+from result_sink import write_orphans
+from inventory import iter_instance_pages
+from metric_data import metric_stat, first_value, average_value
+from query_planner import MetricPlanner
+from metric_history import add_history_columns, record_history
+from rules import match_rules, rule_columns
+from scan_state import split_changed, record_verdicts
 
 
 # Load the config file
-with open('config.yml', 'r') as config_file:
-    config = yaml.safe_load(config_file)
+config = load_config()
 
 region_name = config['region_name']
 diskReadOps = config['diskReadOps']
@@ -17,8 +21,6 @@ cpu_utilisation_threshold = config['cpu_utilisation_threshold']
 diskReadBytes = config['diskReadBytes']
 diskWriteBytes = config['diskWriteBytes']
 min_statusCheckFailed = config['min_statusCheckFailed']   
- 
-cloudwatch_client = boto3.client('cloudwatch', region_name = region_name)
 
 
 def get_instance_name(tags):
@@ -27,167 +29,91 @@ def get_instance_name(tags):
             return tag['Value']
     return ''
 
-def get_ec2_metrics(instance_id):
-    end_time = datetime.datetime.utcnow()
-    start_time = end_time - datetime.timedelta(days=1)
-
-    # Check disk read ops
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='DiskReadOps',
-        Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=86400,
-        Statistics=['Average']
-    )
-    read_ops = response['Datapoints'][0]['Average'] if response['Datapoints'] else 0
-
-    # Check disk write ops
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='DiskWriteOps',
-        Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=86400,
-        Statistics=['Average']
-    )
-    write_ops = response['Datapoints'][0]['Average'] if response['Datapoints'] else 0
-
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='CPUUtilization',
-        Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=86400,
-        Statistics=['Average']
-    )
-    if response['Datapoints']:
-        datapoints = response['Datapoints']
-        avg_cpu_utilization = sum([datapoint['Average'] for datapoint in datapoints]) / len(datapoints)
-
-    response = cloudwatch_client.get_metric_statistics(
-                Namespace='AWS/EC2',
-                MetricName='DiskReadBytes',
-                Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=86400,
-                Statistics=['Average']
-            )
-    readBytes = response['Datapoints'][0]['Average'] if response['Datapoints'] else 0
-
-    response = cloudwatch_client.get_metric_statistics(
-                Namespace='AWS/EC2',
-                MetricName='DiskWriteBytes',
-                Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=86400,
-                Statistics=['Average']
-            )
-    writeBytes = response['Datapoints'][0]['Average'] if response['Datapoints'] else 0
-
-    # Check StatusCheckFailed_Instance metric
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='StatusCheckFailed_Instance',
-        Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=86400,
-        Statistics=['Sum']
-    )
-    
-    statusCheck = response['Datapoints'][0]['Sum'] if response['Datapoints'] else 0
-
-    instance_metrics = dict()
-
-    instance_metrics['instanceID'] = instance_id
-    # instance_metrics['State'] = instance['State']['Name']
-    instance_metrics['DiskReadOps'] = read_ops
-    instance_metrics['DiskWriteOps'] = write_ops
-    instance_metrics['CPU_Util'] = avg_cpu_utilization
-    instance_metrics['DiskReadBytes'] = readBytes
-    instance_metrics['DiskWriteBytes'] = writeBytes
-    instance_metrics['StatusCheckFailed'] = statusCheck
-
-    return instance_metrics
-
-orphaned_ec2_instances_metric = Gauge(
-            'orphaned_ec2_instances',
-            'Number of orphaned EC2 instances',
-            ['instance_id','DiskReadOps', 'DiskWriteOps', 'CPU_Util', 'DiskReadBytes', 'DiskWriteBytes']
-
-            )
-
-def detect_orphan_ec2_instances():
-
-    ec2_client = boto3.client('ec2', region_name = region_name)
+# (metrics dict key, CloudWatch metric name, statistic)
+ec2_metric_queries = [
+    ('DiskReadOps', 'DiskReadOps', 'Average'),
+    ('DiskWriteOps', 'DiskWriteOps', 'Average'),
+    ('CPU_Util', 'CPUUtilization', 'Average'),
+    ('DiskReadBytes', 'DiskReadBytes', 'Average'),
+    ('DiskWriteBytes', 'DiskWriteBytes', 'Average'),
+    ('StatusCheckFailed', 'StatusCheckFailed_Instance', 'Sum'),
+]
+
+def build_ec2_queries(instance_ids):
+    queries = dict()
+    for instance_id in instance_ids:
+        for key, metric_name, stat in ec2_metric_queries:
+            queries[(instance_id, key)] = metric_stat('AWS/EC2', metric_name, 'InstanceId', instance_id, stat, 86400)
+    return queries
+
+def build_ec2_metrics(instance_ids, results):
+    metrics = dict()
+    for instance_id in instance_ids:
+        instance_metrics = dict()
+
+        instance_metrics['instanceID'] = instance_id
+        # instance_metrics['State'] = instance['State']['Name']
+        instance_metrics['DiskReadOps'] = first_value(results[(instance_id, 'DiskReadOps')])
+        instance_metrics['DiskWriteOps'] = first_value(results[(instance_id, 'DiskWriteOps')])
+        instance_metrics['CPU_Util'] = average_value(results[(instance_id, 'CPU_Util')])
+        instance_metrics['DiskReadBytes'] = first_value(results[(instance_id, 'DiskReadBytes')])
+        instance_metrics['DiskWriteBytes'] = first_value(results[(instance_id, 'DiskWriteBytes')])
+        instance_metrics['StatusCheckFailed'] = first_value(results[(instance_id, 'StatusCheckFailed')])
+
+        metrics[instance_id] = instance_metrics
+
+    return metrics
+
+def get_ec2_metrics(instance_ids, planner=None):
+    # Fetch every metric of every instance through the scan's query planner
+    planner = planner or MetricPlanner(get_client('cloudwatch', region=region_name))
+    results = planner.get(build_ec2_queries(instance_ids))
+    return build_ec2_metrics(instance_ids, results)
+
+def detect_orphan_ec2_instances(snapshot=None):
+
     print("\nFinding orphan EC2 Instances...")
     orphan_instances = set()
 
-    # Get all EC2 instances
-    response = ec2_client.describe_instances()
-    instances = response['Reservations']
-    orphan_instances=set()
-    
-    for reservation in instances:
-        for instance in reservation['Instances']:
-            instance_metrics = dict()
-            instance_id = instance['InstanceId']
-            instance_name = get_instance_name(instance.get('Tags', []))
-            instance_metrics = get_ec2_metrics(instance_id)
-
-        
-            # Check instance status
-            if instance['State']['Name'] == 'failed':
-                orphan_instances.add(('EC2', instance_id, instance_metrics.values()))
-                orphaned_ec2_instances_metric.labels(instance_id=instance_id,DiskReadOps=instance_metrics['DiskReadOps'] , DiskWriteOps=instance_metrics['DiskWriteOps'] , CPU_Util=instance_metrics['CPU_Util'], DiskReadBytes=instance_metrics['DiskWriteBytes'], DiskWriteBytes=instance_metrics['DiskWriteBytes']).set(1)
-
-                
-            elif instance_metrics['DiskReadOps'] == diskReadOps:
-                # No disk read ops recorded in the last 5 minutes
-                orphan_instances.add(('EC2', instance_id, instance_metrics.values()))
-                orphaned_ec2_instances_metric.labels(instance_id=instance_id,DiskReadOps=instance_metrics['DiskReadOps'] , DiskWriteOps=instance_metrics['DiskWriteOps'] , CPU_Util=instance_metrics['CPU_Util'], DiskReadBytes=instance_metrics['DiskWriteBytes'], DiskWriteBytes=instance_metrics['DiskWriteBytes']).set(1)
-
-            elif instance_metrics['DiskWriteOps'] == diskWriteOps:
-                # No disk write ops recorded in the last 5 minutes
-                    orphan_instances.add(('EC2', instance_id, instance_metrics.values()))
-                    orphaned_ec2_instances_metric.labels(instance_id=instance_id,DiskReadOps=instance_metrics['DiskReadOps'] , DiskWriteOps=instance_metrics['DiskWriteOps'] , CPU_Util=instance_metrics['CPU_Util'], DiskReadBytes=instance_metrics['DiskWriteBytes'], DiskWriteBytes=instance_metrics['DiskWriteBytes']).set(1)
-
-            elif  instance_metrics['CPU_Util'] < cpu_utilisation_threshold:
-                # No CPU utilization recorded in the last 5 minutes\
-                orphan_instances.add(('EC2', instance_id, instance_metrics.values()))
-                orphaned_ec2_instances_metric.labels(instance_id=instance_id,DiskReadOps=instance_metrics['DiskReadOps'] , DiskWriteOps=instance_metrics['DiskWriteOps'] , CPU_Util=instance_metrics['CPU_Util'], DiskReadBytes=instance_metrics['DiskWriteBytes'], DiskWriteBytes=instance_metrics['DiskWriteBytes']).set(1)
-
-            elif instance_metrics['DiskReadBytes'] == diskReadBytes:
-                # No disk read bytes recorded in the last 5 minutes\
-                orphan_instances.add(('EC2', instance_id, instance_metrics.values()))
-                orphaned_ec2_instances_metric.labels(instance_id=instance_id,DiskReadOps=instance_metrics['DiskReadOps'] , DiskWriteOps=instance_metrics['DiskWriteOps'] , CPU_Util=instance_metrics['CPU_Util'], DiskReadBytes=instance_metrics['DiskWriteBytes'], DiskWriteBytes=instance_metrics['DiskWriteBytes']).set(1)
-   
-            elif instance_metrics['DiskWriteBytes'] == diskWriteBytes:
-                # No disk write bytes recorded in the last 5 minutes
-                orphan_instances.add(('EC2', instance_id, instance_metrics.values()))
-                orphaned_ec2_instances_metric.labels(instance_id=instance_id,DiskReadOps=instance_metrics['DiskReadOps'] , DiskWriteOps=instance_metrics['DiskWriteOps'] , CPU_Util=instance_metrics['CPU_Util'], DiskReadBytes=instance_metrics['DiskWriteBytes'], DiskWriteBytes=instance_metrics['DiskWriteBytes']).set(1)
-
-            elif instance_metrics['StatusCheckFailed'] >= min_statusCheckFailed:
-                # StatusCheckFailed recorded in the last 5 minutes
-                orphan_instances.add(('EC2', instance_id, instance_metrics.values()))
-                orphaned_ec2_instances_metric.labels(instance_id=instance_id,DiskReadOps=instance_metrics['DiskReadOps'] , DiskWriteOps=instance_metrics['DiskWriteOps'] , CPU_Util=instance_metrics['CPU_Util'], DiskReadBytes=instance_metrics['DiskWriteBytes'], DiskWriteBytes=instance_metrics['DiskWriteBytes']).set(1)
-               
-              
-    add_to_csv(orphan_instances)
-    return orphan_instances
+    # Reuse the scan snapshot when there is one, otherwise stream the instances
+    if snapshot:
+        instance_pages = snapshot.pages('instances')
+        planner = snapshot.metric_planner()
+    else:
+        instance_pages = iter_instance_pages(get_client('ec2', region=region_name))
+        planner = MetricPlanner(get_client('cloudwatch', region=region_name))
 
+    # Walk the EC2 instances page by page
+    for instances in instance_pages:
+        page_orphans = detect_orphan_ec2_page(instances, planner)
+        write_orphans(page_orphans)
+        orphan_instances.update(page_orphans)
 
-    
+    return orphan_instances
 
-    
+def detect_orphan_ec2_page(instances, planner=None):
+    # Only new, changed or stale instances are evaluated in incremental mode
+    instances, known_orphans = split_changed('EC2', instances)
+    all_metrics = get_ec2_metrics([instance['InstanceId'] for instance in instances], planner)
+    orphan_instances = evaluate_ec2_page(instances, all_metrics)
+    record_verdicts('EC2', instances, orphan_instances)
+    return orphan_instances.union(known_orphans)
 
+def evaluate_ec2_page(instances, all_metrics):
+    orphan_instances = set()
 
+    # Every rule of config.yml is checked against the whole page at once,
+    # windows of the metric history included
+    record_history('EC2', all_metrics)
+    records = [dict(all_metrics[instance['InstanceId']], State=instance['State']['Name']) for instance in instances]
+    add_history_columns('EC2', [instance['InstanceId'] for instance in instances], records, rule_columns('EC2'))
+    matched_rules = match_rules('EC2', records)
 
+    for instance, matched in zip(instances, matched_rules):
+        if not matched:
+            continue
 
+        instance_id = instance['InstanceId']
+        orphan_instances.add(orphan_record('EC2', instance_id, all_metrics[instance_id], matched))
 
+    return orphan_instances
@@ -1,18 +1,18 @@
-import boto3
-import yaml
-from add_to_csv import add_to_csv
+from clients import get_client
+from config import load_config
+from records import OrphanRecord
+from result_sink import write_orphans
+from inventory import iter_instance_pages, iter_address_pages
 from prometheus_client import Gauge
 
 
 
 # Load the config file
-with open('config.yml', 'r') as config_file:
-    config = yaml.safe_load(config_file)
+config = load_config()
     
 region_name = config['region_name']
 
 region_name = region_name
-cloudwatch_client = boto3.client('cloudwatch', region_name = region_name)
 
 region_metric = Gauge(
     'aws_region_name',
@@ -20,40 +20,43 @@ region_metric = Gauge(
     labelnames=['aws_region']
 )
 
-orphaned_eips_metric = Gauge(
-    'orphaned_eips',
-    'Number of orphaned Elastic IPs', 
-    labelnames=['eip_id']
-)
-def get_orphaned_eips():
+def get_orphaned_eips(snapshot=None):
 
     print("\nFinding orphaned Elastic IPs...")
-    ec2 = boto3.client('ec2', region_name= region_name)
-    region_metric.labels(aws_region= region_name).set(1)
+    region_metric.labels(aws_region= snapshot.region_name if snapshot else region_name).set(1)
+
+    # Reuse the scan snapshot when there is one, otherwise describe directly
+    if snapshot:
+        instance_pages = snapshot.pages('instances')
+        address_pages = snapshot.pages('addresses')
+    else:
+        ec2 = get_client('ec2', region=region_name)
+        instance_pages = iter_instance_pages(ec2)
+        address_pages = iter_address_pages(ec2)
 
-    # Retrieve all allocated Elastic IPs
-    response = ec2.describe_addresses()
-    allocated_eips = [address['PublicIp'] for address in response['Addresses']]
-    
     # Retrieve all associated Elastic IPs
-    orphan_eip = set()
     associated_eips = set()
-    response = ec2.describe_instances()
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            if 'PublicIpAddress' in instance:
-                associated_eips.add(instance['PublicIpAddress'])
-    
+    for instances in instance_pages:
+        associated_eips.update(get_associated_eips(instances))
+
     # Compare allocated and associated EIPs to find orphaned ones
-    orphaned_eips = set(allocated_eips) - associated_eips
+    orphaned_eips = set()
+    for addresses in address_pages:
+        page_orphans = evaluate_eip_page(addresses, associated_eips)
+        write_orphans(page_orphans)
+        orphaned_eips.update(page_orphans)
 
-    
-    for eip in orphaned_eips:
-        orphan_eip.add(('EIP', eip))
-        orphaned_eips_metric.labels(eip_id=eip).set(1)
+    return orphaned_eips
 
+def get_associated_eips(instances):
+    return {instance['PublicIpAddress'] for instance in instances if 'PublicIpAddress' in instance}
 
+def evaluate_eip_page(addresses, associated_eips):
+    orphaned_eips = set()
+    for address in addresses:
+        eip = address['PublicIp']
+        if eip not in associated_eips:
+            orphaned_eips.add(OrphanRecord('EIP', eip, (), ('unassociated',)))
 
-    add_to_csv((orphan_eip))
     return orphaned_eips
 
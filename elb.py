@@ -1,107 +1,107 @@
-import boto3
-import datetime
-from add_to_csv import add_to_csv
-import yaml
-from prometheus_client import Gauge
+from clients import get_client
+from records import orphan_record
+from result_sink import write_orphans
+from inventory import iter_load_balancer_pages
+from metric_data import metric_stat, first_value
+from metric_history import record_history
+from query_planner import MetricPlanner
+from config import load_config
+from scan_state import split_changed, record_verdicts
 
 
 # Load the config file
-with open('config.yml', 'r') as config_file:
-    config = yaml.safe_load(config_file)
+config = load_config()
     
 region_name = config['region_name']
 healthyHostCount_threshold = config['healthyHostCount_threshold']
 requestCount_threshold = config['requestCount_threshold']
 
-cloudwatch_client = boto3.client('cloudwatch', region_name = region_name)
-
-
-def get_elb_metrics(lb_arn):
-    # Check the HealthyHostCount metric
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/ApplicationELB',
-        MetricName='HealthyHostCount',
-        Dimensions=[
-            {
-                'Name': 'LoadBalancer',
-                'Value': lb_arn.split('/')[1]
-            },
-        ],
-        StartTime=datetime.datetime.utcnow() - datetime.timedelta(days=1),
-        EndTime=datetime.datetime.utcnow(),
-        Period=86400, 
-        Statistics=['Average']
-    )
-    if response['Datapoints']:
-        elb_health = response['Datapoints'][0]['Average']
-    else:
-        elb_health = 0
-
-    # Check the RequestCount metric
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/ApplicationELB',
-        MetricName='RequestCount',
-        Dimensions=[
-            {
-                'Name': 'LoadBalancer',
-                'Value': lb_arn.split('/')[1]
-            },
-        ],
-        StartTime=datetime.datetime.utcnow() - datetime.timedelta(days = 1),
-        EndTime=datetime.datetime.utcnow(),
-        Period=86400,
-        Statistics=['Sum']
-    )
-    if response['Datapoints']:
-        elb_request_count = response['Datapoints'][0]['Sum']
-    else:
-        elb_request_count = 0
-    
-    elb_metrics = dict()
-    elb_metrics['elb_arn'] = lb_arn
-    elb_metrics['HealthyHostCount'] = elb_health
-    elb_metrics['RequestCount'] = elb_request_count
-
-    return elb_metrics
-
-orphaned_elb_metric = Gauge(
-    'orphaned_elb',
-    'Number of orphaned elb',
-    ['elb_id']
-    )
-def detect_orphaned_load_balancers():
+
+# (metrics dict key, CloudWatch metric name, statistic)
+elb_metric_queries = [
+    ('HealthyHostCount', 'HealthyHostCount', 'Average'),
+    ('RequestCount', 'RequestCount', 'Sum'),
+]
+
+def load_balancer_dimension(lb_arn):
+    # The LoadBalancer dimension is the ARN's text after loadbalancer/, app/<name>/<id>
+    return lb_arn.split(':loadbalancer/', 1)[1]
+
+def build_elb_queries(lb_arns):
+    queries = dict()
+    for lb_arn in lb_arns:
+        for key, metric_name, stat in elb_metric_queries:
+            queries[(lb_arn, key)] = metric_stat('AWS/ApplicationELB', metric_name, 'LoadBalancer', load_balancer_dimension(lb_arn), stat, 86400)
+    return queries
+
+def build_elb_metrics(lb_arns, results):
+    metrics = dict()
+    for lb_arn in lb_arns:
+        elb_metrics = dict()
+        elb_metrics['elb_arn'] = lb_arn
+        elb_metrics['HealthyHostCount'] = first_value(results[(lb_arn, 'HealthyHostCount')])
+        elb_metrics['RequestCount'] = first_value(results[(lb_arn, 'RequestCount')])
+
+        metrics[lb_arn] = elb_metrics
+
+    return metrics
+
+def get_elb_metrics(lb_arns, planner=None):
+    # Fetch every metric of every load balancer through the scan's query planner
+    planner = planner or MetricPlanner(get_client('cloudwatch', region=region_name))
+    results = planner.get(build_elb_queries(lb_arns))
+    return build_elb_metrics(lb_arns, results)
+
+def detect_orphaned_load_balancers(snapshot=None):
     print("\nFinding orphaned Load Balancers...")
-    elbv2_client = boto3.client('elbv2', region_name = region_name)
 
-    # Retrieve the list of load balancers
-    response = elbv2_client.describe_load_balancers()
-    load_balancers = response['LoadBalancers']
+    # Reuse the scan snapshot when there is one, otherwise stream the load balancers
+    if snapshot:
+        load_balancer_pages = snapshot.pages('load_balancers')
+        planner = snapshot.metric_planner()
+    else:
+        load_balancer_pages = iter_load_balancer_pages(get_client('elbv2', region=region_name))
+        planner = MetricPlanner(get_client('cloudwatch', region=region_name))
+
+    orphaned_load_balancers = []
+
+    # Walk the load balancers page by page
+    for load_balancers in load_balancer_pages:
+        page_orphans = detect_orphaned_load_balancer_page(load_balancers, planner)
+        write_orphans(page_orphans)
+        orphaned_load_balancers.extend(page_orphans)
+
+    return orphaned_load_balancers
+
+def detect_orphaned_load_balancer_page(load_balancers, planner=None):
+    # Only new, changed or stale load balancers are evaluated in incremental mode
+    load_balancers, known_orphans = split_changed('ELB', load_balancers)
+    all_metrics = get_elb_metrics([lb['LoadBalancerArn'] for lb in load_balancers], planner)
+    orphaned_load_balancers = evaluate_load_balancer_page(load_balancers, all_metrics)
+    record_verdicts('ELB', load_balancers, orphaned_load_balancers)
+    return orphaned_load_balancers + known_orphans
 
+def evaluate_load_balancer_page(load_balancers, all_metrics):
     orphaned_load_balancers = []
     potentially_orphaned_load_balancers = []
+    record_history('ELB', all_metrics)
 
-    
     for lb in load_balancers:
         lb_arn = lb['LoadBalancerArn']
         elb_id = lb_arn.split(':')[-1]
 
-        lb_metrics = get_elb_metrics(lb_arn)
+        lb_metrics = all_metrics[lb_arn]
 
-        elb_id = lb_arn.split(':')[-1]
-        orphaned_elb_metric.labels(elb_id=elb_id).set(lb_metrics['HealthyHostCount'])
-        orphaned_elb_metric.labels(elb_id=elb_id).set(lb_metrics['RequestCount'])       
-  
-        if not lb_metrics['HealthyHostCount'] or lb_metrics['HealthyHostCount'][0]['Average']  == healthyHostCount_threshold:
+        if not lb_metrics['HealthyHostCount'] or lb_metrics['HealthyHostCount'] == healthyHostCount_threshold:
             # No healthy hosts recorded in the last 5 minutes
-            orphaned_load_balancers.append(('ELB', elb_id, lb_metrics.values()))
+            orphaned_load_balancers.append(orphan_record('ELB', elb_id, lb_metrics, ('no_healthy_hosts',)))
         else:
-            if not lb_metrics['RequestCount'] or lb_metrics['RequestCount'][0]['Sum'] < requestCount_threshold:
+            if not lb_metrics['RequestCount'] or lb_metrics['RequestCount'] < requestCount_threshold:
                 # Request count is less than 500 in the last 5 minutes
-                potentially_orphaned_load_balancers.append(('Potential ELB', elb_id, lb_metrics.values()))
-                add_to_csv(potentially_orphaned_load_balancers)
-
-    add_to_csv(orphaned_load_balancers)
+                potentially_orphaned_load_balancers.append(orphan_record('Potential ELB', elb_id, lb_metrics, ('low_request_count',)))
 
+    # Written once per page, they are reported but not returned as orphans
+    write_orphans(potentially_orphaned_load_balancers)
     return orphaned_load_balancers
 
 
@@ -0,0 +1,75 @@
+import os
+from result_sink import columns, text_columns, orphan_row
+
+
+# Excel caps a sheet at 1,048,576 rows, header included
+max_sheet_rows = 1048576
+
+# Sheets every workbook has, in this order, even when nothing was found
+report_sheets = ['EC2', 'VOLUME', 'RDS', 'ELB', 'EIP']
+
+
+class ReportSheets:
+    # Worksheets of one resource type, continued on a new sheet when full
+
+    def __init__(self, workbook, resource_type, formats):
+        self.workbook = workbook
+        self.resource_type = resource_type
+        self.columns = columns(resource_type)
+        self.text = formats['text']
+        self.formats = [formats['text'] if column in text_columns else formats['number'] for column in self.columns]
+        self.header = formats['header']
+        self.sheets = 0
+        self._add_sheet()
+
+    def _add_sheet(self):
+        self.sheets += 1
+        name = self.resource_type if self.sheets == 1 else '{} ({})'.format(self.resource_type, self.sheets)
+        self.sheet = self.workbook.add_worksheet(name[:31])
+        self.sheet.write_row(0, 0, self.columns, self.header)
+        self.sheet.freeze_panes(1, 0)
+        self.row = 1
+
+    def write(self, values):
+        if self.row == max_sheet_rows:
+            self._add_sheet()
+
+        # Cells are typed by column, text stays text and metrics stay numbers
+        for col, (value, cell_format) in enumerate(zip(values, self.formats)):
+            if value is None or value == '':
+                continue
+            if cell_format is self.text or isinstance(value, str):
+                self.sheet.write_string(self.row, col, str(value), cell_format)
+            else:
+                self.sheet.write_number(self.row, col, value, cell_format)
+        self.row += 1
+
+
+def write_excel_report(path, phases):
+    # phases yields (account_id, region, orphans). Rows go
+    # straight to disk: in constant_memory mode xlsxwriter keeps only the
+    # current row of each sheet, so memory stays flat however big the estate
+    # xlsxwriter is only needed by scans that write a workbook
+    import xlsxwriter
+    temporary_path = path + '.tmp'
+    workbook = xlsxwriter.Workbook(temporary_path, {'constant_memory': True})
+    formats = {
+        'header': workbook.add_format({'bold': True}),
+        'text': workbook.add_format({'num_format': '@'}),
+        'number': workbook.add_format({'num_format': 'General'}),
+    }
+
+    sheets = {resource_type: ReportSheets(workbook, resource_type, formats) for resource_type in report_sheets}
+    rows = 0
+    for account_id, region, orphans in phases:
+        for orphan in orphans:
+            resource_type, values = orphan_row(orphan, account_id, region)
+            if resource_type not in sheets:
+                sheets[resource_type] = ReportSheets(workbook, resource_type, formats)
+            sheets[resource_type].write(values)
+            rows += 1
+
+    workbook.close()
+    # Readers never see a half written workbook
+    os.replace(temporary_path, path)
+    return rows
@@ -0,0 +1,99 @@
+import numbers
+import threading
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from rules import rule_severity
+
+
+# Orphans are exported from a snapshot of the last scan instead of labelled
+# Gauges. Labels are bounded (resource type, id, account, region, reason and
+# its rule's severity, or metric name), every metric value is its own series, and a resource that is
+# no longer orphaned simply disappears from the next snapshot.
+
+def orphan_samples(account_id, region, orphans):
+    # Returns the (labels, value) samples of one detector's orphan records,
+    # labelled with their account since the same identifier can exist in
+    # several accounts of one region
+    account_id = account_id or ''
+    orphan_series = []
+    metric_series = []
+    for orphan in orphans:
+        resource_type, resource_id = orphan.resource_type, str(orphan.resource_id)
+        for reason in orphan.reasons or ('detected',):
+            severity = rule_severity(resource_type, reason) or ''
+            orphan_series.append(((resource_type, resource_id, account_id, region, reason, severity), 1))
+
+        # Only numeric metrics are exported, ids, dates and tags are not
+        for metric, value in orphan.metrics():
+            if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                metric_series.append(((resource_type, resource_id, account_id, region, metric), value))
+
+    return orphan_series, metric_series
+
+
+class OrphanCollector:
+
+    def __init__(self):
+        # (account, region, detector) -> samples of its last successful run
+        self.snapshot = dict()
+        # Publishers are serialised, scrapes read whichever snapshot is current
+        self.lock = threading.Lock()
+
+    def publish(self, target_results):
+        with self.lock:
+            snapshot = dict(self.snapshot)
+            for target_result in target_results:
+                if target_result.error:
+                    continue
+                for name, phase in target_result.phases.items():
+                    # A failed phase keeps the orphans of its last good run
+                    if phase.error:
+                        continue
+                    key = (target_result.account_id, target_result.target.region, name)
+                    snapshot[key] = orphan_samples(target_result.account_id, target_result.target.region, phase.result)
+
+            # Swapping the reference is atomic, a scrape sees the old or new snapshot
+            self.snapshot = snapshot
+
+    def collect(self):
+        snapshot = self.snapshot
+
+        orphaned = GaugeMetricFamily(
+            'orphaned_resource',
+            'Orphaned resource found by the last scan, one series per reason',
+            labels=['resource_type', 'resource_id', 'account_id', 'region', 'reason', 'severity']
+        )
+        metric_values = GaugeMetricFamily(
+            'orphaned_resource_metric',
+            'CloudWatch metric value of an orphaned resource',
+            labels=['resource_type', 'resource_id', 'account_id', 'region', 'metric']
+        )
+        counts = GaugeMetricFamily(
+            'orphaned_resources',
+            'Number of orphaned resources found by the last scan',
+            labels=['detector', 'region']
+        )
+
+        # Several accounts may share a region, so counts are summed first
+        totals = dict()
+        for (account_id, region, name), (orphan_series, metric_series) in snapshot.items():
+            for labels, value in orphan_series:
+                orphaned.add_metric(labels, value)
+            for labels, value in metric_series:
+                metric_values.add_metric(labels, value)
+            resources = len({labels[1] for labels, value in orphan_series})
+            totals[(name, region)] = totals.get((name, region), 0) + resources
+
+        for labels, total in totals.items():
+            counts.add_metric(labels, total)
+
+        yield orphaned
+        yield metric_values
+        yield counts
+
+
+orphan_collector = OrphanCollector()
+REGISTRY.register(orphan_collector)
+
+
+def publish_orphans(target_results):
+    orphan_collector.publish(target_results)
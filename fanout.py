@@ -0,0 +1,53 @@
+import collections
+import concurrent.futures
+import time
+import traceback
+from inventory import InventorySnapshot
+from orchestrator import run_detectors
+
+
+# One (profile, region) pair to scan, and what came back from it
+Target = collections.namedtuple('Target', ['profile', 'region'])
+TargetResult = collections.namedtuple('TargetResult', ['target', 'account_id', 'phases', 'error'])
+
+
+def get_targets(config):
+    # default means the default credential chain, not a profile that has to
+    # exist in ~/.aws/config
+    profiles = [None if profile == 'default' else profile for profile in config.get('profiles') or [None]]
+    regions = config.get('regions') or [config['region_name']]
+    return [Target(profile, region) for profile in profiles for region in regions]
+
+
+def scan_target(target, detectors, parallel=True, max_workers=5, engine='threads', concurrency=64, endpoint_url=None):
+    try:
+        if engine == 'async':
+            # aiobotocore is only needed when the asyncio engine is selected
+            import async_scan
+            account_id, phases = async_scan.scan(target.region, target.profile, list(detectors), concurrency, endpoint_url)
+            return TargetResult(target, account_id, phases, None)
+
+        # Each target gets its own session and clients through its snapshot
+        snapshot = InventorySnapshot(target.region, profile=target.profile)
+        account_id = snapshot.client('sts').get_caller_identity()['Account']
+        snapshot.account_id = account_id
+        phases = run_detectors(detectors, snapshot, parallel=parallel, max_workers=max_workers)
+        return TargetResult(target, account_id, phases, None)
+    except Exception as e:
+        print("\nScan of profile {} in {} failed:".format(target.profile, target.region))
+        traceback.print_exc()
+        return TargetResult(target, None, dict(), e)
+
+
+def scan_targets(targets, detectors, parallel=True, max_workers=5, max_targets=8, engine='threads', concurrency=64, endpoint_url=None):
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_targets) as executor:
+        futures = [
+            executor.submit(scan_target, target, detectors, parallel, max_workers, engine, concurrency, endpoint_url)
+            for target in targets
+        ]
+        target_results = [future.result() for future in futures]
+
+    print("\nScanned {} targets in {:.2f}s".format(len(targets), time.perf_counter() - start))
+    return target_results
@@ -0,0 +1,149 @@
+import re
+import threading
+from botocore.exceptions import ClientError
+from config import load_config
+
+
+# Load the config file
+config = load_config()
+
+metric_fleet_queries = config.get('metric_fleet_queries', False)
+metric_fleet_namespaces = config.get('metric_fleet_namespaces', ['AWS/EC2', 'AWS/EBS', 'AWS/RDS'])
+metric_fleet_limit = config.get('metric_fleet_limit', 500)
+metric_fleet_max_hours = config.get('metric_fleet_max_hours', 3)
+
+# Metrics Insights only reads the last metric_fleet_max_hours, and the scan
+# window can start up to one metric_window_align before its hours
+window_hours = config.get('metric_window_hours', 24) + config.get('metric_window_align', 3600) / 3600
+if metric_fleet_queries and window_hours > metric_fleet_max_hours:
+    raise ValueError(
+        "metric_fleet_queries needs the metric window within the last metric_fleet_max_hours ({}h), but "
+        "metric_window_hours plus metric_window_align reach back {:g}h: lower metric_window_hours or turn "
+        "metric_fleet_queries off".format(metric_fleet_max_hours, window_hours)
+    )
+
+
+# CloudWatch Metrics Insights fleet queries. One query such as
+#   SELECT AVG(CPUUtilization) FROM SCHEMA("AWS/EC2", InstanceId) GROUP BY InstanceId LIMIT 500
+# returns the series of every instance at once, each labelled with its
+# instance id. The planner of a scan sends one per namespace, metric,
+# statistic and period the first time a page asks for it, all the metrics a
+# page needs in the same request, and joins the series to the resources by
+# dimension value. A fleet query returns at most metric_fleet_limit series:
+# when it returns fewer, a resource missing from it has no datapoints; when
+# it is full, the resources missing from it are queried one by one.
+#
+# Metrics Insights only reads the most recent hours of data, so a config
+# turning fleet queries on with a longer window is rejected when loaded. It
+# cannot filter by unit either, which the AWS metrics, published in a single
+# unit, do not need.
+
+insights_functions = {'Average': 'AVG', 'Sum': 'SUM', 'Maximum': 'MAX', 'Minimum': 'MIN', 'SampleCount': 'COUNT'}
+
+
+def fleet_key(query):
+    # Queries answered by the same fleet query share a key, None when no
+    # fleet query answers the query
+    metric = query['Metric']
+    if metric['Namespace'] not in metric_fleet_namespaces or len(metric['Dimensions']) != 1:
+        return None
+    if query['Stat'] not in insights_functions:
+        return None
+    return metric['Namespace'], metric['MetricName'], metric['Dimensions'][0]['Name'], query['Stat'], query['Period']
+
+
+def identifier(name):
+    # Names such as EBSByteBalance% have to be quoted
+    return name if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name) else '"{}"'.format(name)
+
+
+def fleet_expression(namespace, metric_name, dimension_name, stat, limit):
+    return 'SELECT {}({}) FROM SCHEMA("{}", {}) GROUP BY {} LIMIT {}'.format(
+        insights_functions[stat], identifier(metric_name), namespace, identifier(dimension_name),
+        identifier(dimension_name), limit
+    )
+
+
+class FleetMetrics:
+
+    def __init__(self, cloudwatch_client, start_time, end_time, limit=None):
+        self.cloudwatch_client = cloudwatch_client
+        self.start_time = start_time
+        self.end_time = end_time
+        self.limit = limit or metric_fleet_limit
+        self.lock = threading.Lock()
+        # fleet key -> (values by dimension value, whether the fleet query
+        # returned every series), None when it failed, or an Event while a
+        # caller is fetching it
+        self.fleets = dict()
+
+    def split(self, queries):
+        # queries maps a caller chosen key to a MetricStat dict. Returns the
+        # values of the queries the fleet queries answer, and the queries left
+        keys = {key: fleet_key(query) for key, query in queries.items()}
+        self._fetch_missing({fleet for fleet in keys.values() if fleet})
+
+        answered = dict()
+        remaining = dict()
+        for key, query in queries.items():
+            fleet = self.fleets.get(keys[key]) if keys[key] else None
+            dimension_value = query['Metric']['Dimensions'][0]['Value']
+            if fleet and (dimension_value in fleet[0] or fleet[1]):
+                answered[key] = fleet[0].get(dimension_value, [])
+            else:
+                remaining[key] = query
+        return answered, remaining
+
+    def _fetch_missing(self, fleets):
+        with self.lock:
+            missing = [fleet for fleet in fleets if fleet not in self.fleets]
+            fetched = threading.Event()
+            for fleet in missing:
+                self.fleets[fleet] = fetched
+            # Fleets another caller is fetching are waited for
+            waits = {self.fleets[fleet] for fleet in fleets if isinstance(self.fleets[fleet], threading.Event)}
+            waits.discard(fetched)
+
+        results = dict()
+        try:
+            if missing:
+                results = self._fetch(missing)
+        except ClientError as error:
+            print("\nMetrics Insights fleet queries failed, querying resources one by one: {}".format(error))
+        finally:
+            with self.lock:
+                for fleet in missing:
+                    self.fleets[fleet] = results.get(fleet)
+            fetched.set()
+
+        for event in waits:
+            event.wait()
+
+    def _fetch(self, fleets):
+        # Every fleet query goes in one request, paged through NextToken
+        ids = {'f{}'.format(index): fleet for index, fleet in enumerate(fleets)}
+        series = {fleet: dict() for fleet in fleets}
+        kwargs = dict(
+            MetricDataQueries=[{
+                'Id': query_id,
+                'Expression': fleet_expression(namespace, metric_name, dimension_name, stat, self.limit),
+                'Period': period,
+                'ReturnData': True,
+            } for query_id, (namespace, metric_name, dimension_name, stat, period) in ids.items()],
+            StartTime=self.start_time,
+            EndTime=self.end_time,
+            ScanBy='TimestampDescending'
+        )
+
+        while True:
+            response = self.cloudwatch_client.get_metric_data(**kwargs)
+            # Grouped series are labelled with their dimension value
+            for result in response['MetricDataResults']:
+                series[ids[result['Id']]].setdefault(result['Label'], []).extend(result.get('Values', []))
+
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+            kwargs['NextToken'] = next_token
+
+        return {fleet: (values, len(values) < self.limit) for fleet, values in series.items()}
@@ -1,52 +1,155 @@
-from prometheus_client import start_http_server
-from ec2 import detect_orphan_ec2_instances
-from volumes import detect_orphan_volumes
-from elb import detect_orphaned_load_balancers
-from eip import get_orphaned_eips
-from rds import detect_orphaned_rds_instances
+import argparse
+import importlib
+import sys
+import threading
 import time
-import pandas as pd
+from config import load_config
+
+
+# Detector name -> (module, function). Detector modules are only imported
+# when their detector is selected, so a targeted run pays for nothing else
+detector_functions = {
+    'EIP': ('eip', 'get_orphaned_eips'),
+    'EC2': ('ec2', 'detect_orphan_ec2_instances'),
+    'Volume': ('volumes', 'detect_orphan_volumes'),
+    'ELB': ('elb', 'detect_orphaned_load_balancers'),
+    'RDS': ('rds', 'detect_orphaned_rds_instances'),
+}
+
+
+def load_detectors(names=None):
+    detectors = dict()
+    for name in names or detector_functions:
+        module_name, function_name = detector_functions[name]
+        detectors[name] = getattr(importlib.import_module(module_name), function_name)
+    return detectors
+
+
+class ScanRunner:
+    # Runs scans of the configured targets and hands their results to the
+    # Prometheus exporter and the Excel report
+
+    def __init__(self, config):
+        from fanout import get_targets
+
+        self.concurrent_detectors = config.get('concurrent_detectors', True)
+        self.max_workers = config.get('max_workers', 5)
+        self.max_targets = config.get('max_targets', 8)
+        self.scan_engine = config.get('scan_engine', 'threads')
+        self.async_concurrency = config.get('async_concurrency', 64)
+        self.endpoint_url = config.get('endpoint_url')
+        self.excel_report = config.get('excel_report', 'orphaned_resources.xlsx')
+        self.excel_report_interval = config.get('excel_report_interval', 3600)
+        self.targets = get_targets(config)
+
+        # Latest orphans of every (account, region, detector), for the Excel report
+        self.latest_phases = dict()
+        self.latest_phases_lock = threading.Lock()
+        # When the workbook was last written, and whether results came in since
+        self.report_written_at = None
+        self.report_pending = False
+
+    def write_report_workbook(self, target_results):
+        from excel_report import write_excel_report
+
+        with self.latest_phases_lock:
+            for target_result in target_results:
+                if target_result.error:
+                    continue
+                for name, phase in target_result.phases.items():
+                    if not phase.error:
+                        self.latest_phases[(target_result.account_id, target_result.target.region, name)] = phase.result
+                        self.report_pending = True
+
+            # Frequent runs such as EIP's would rewrite the whole workbook
+            # every few minutes, so it is written at most once per interval
+            if not self.report_pending:
+                return
+            now = time.monotonic()
+            if self.report_written_at is not None and now - self.report_written_at < self.excel_report_interval:
+                return
+
+            # Scheduled runs finish concurrently, so workbooks are written one at a time
+            rows = write_excel_report(self.excel_report, (
+                (account_id, region, result) for (account_id, region, name), result in self.latest_phases.items()
+            ))
+            self.report_written_at = now
+            self.report_pending = False
+        print("\nWrote {} orphans to {}".format(rows, self.excel_report))
+
+    def run_scan(self, scan_detectors):
+        from exporter import publish_orphans
+        from fanout import scan_targets
+        from result_sink import flush_orphans
+
+        # Every (profile, region) target is scanned with its own inventory snapshot
+        target_results = scan_targets(self.targets, scan_detectors, parallel=self.concurrent_detectors, max_workers=self.max_workers,
+                                      max_targets=self.max_targets, engine=self.scan_engine, concurrency=self.async_concurrency,
+                                      endpoint_url=self.endpoint_url)
+        # Detectors wrote their orphans page by page, stamped with their target
+        flush_orphans()
+        # Swap the exported orphans of these detectors for the ones this scan found
+        publish_orphans(target_results)
+        if self.excel_report:
+            self.write_report_workbook(target_results)
+        return target_results
+
+
+def scan_failed(target_results):
+    return any(
+        target_result.error or any(phase.error for phase in target_result.phases.values())
+        for target_result in target_results
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Find orphaned AWS resources')
+    parser.add_argument('detectors', nargs='*', metavar='detector',
+                        help='detectors to run: {} (default: all)'.format(', '.join(detector_functions)))
+    parser.add_argument('--config', help='config file (default: ORPHANS_CONFIG or config.yml)')
+    parser.add_argument('--once', action='store_true',
+                        help='run one scan and exit instead of serving metrics and scanning on schedule')
+    parser.add_argument('--no-excel', action='store_true', help='do not write the Excel report')
+    parser.add_argument('--profiling', action='store_true', help='profile every detector phase, see profile_dir')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.detectors if name not in detector_functions]
+    if unknown:
+        parser.error("unknown detector {}, expected one of {}".format(', '.join(unknown), ', '.join(detector_functions)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # The config is read here, once, before any module that uses it is imported
+    config = load_config(args.config)
+    if args.profiling:
+        from profiling import enable_profiling
+        enable_profiling()
+
+    detectors = load_detectors(args.detectors)
+    runner = ScanRunner(config)
+    if args.no_excel:
+        runner.excel_report = None
+
+    if args.once:
+        # One scan for cron style runs, the exit status tells whether it was complete
+        target_results = runner.run_scan(detectors)
+        return 1 if scan_failed(target_results) else 0
+
+    from prometheus_client import start_http_server
+    from scheduler import Scheduler, start_trigger_server
+
+    start_http_server(8090)
+
+    # Each detector runs on its own interval, POST /scan[/<detector>] on the trigger port runs it now
+    schedule = config.get('schedule') or dict()
+    scheduler = Scheduler(detectors, runner.run_scan, schedule, default_interval=config.get('scan_interval', 86400),
+                          default_jitter=config.get('scan_jitter', 0))
+    start_trigger_server(scheduler, config.get('trigger_port', 8091), config.get('trigger_addr', '127.0.0.1'))
+    scheduler.run_forever()
+
 
 if __name__ == '__main__':
-   
-   start_http_server(8090)
-
-   while True:
-    orphaned_eips = get_orphaned_eips()
-    orphan_instances = set()
-    detect_orphan_ec2_instances()
-    orphan_volumes = set()
-    detect_orphan_volumes()
-    orphaned_lbs= detect_orphaned_load_balancers()
-    orphan_databases = set()
-    detect_orphaned_rds_instances()
-    time.sleep(86400)
-
-#Add to excel
-    def add_to_excel(): 
-       output_file = 'orphaned_resources.xlsx'
-       writer= pd.ExcelWriter(output_file, engine='xlsxwriter')
-
-       ec2_headers = ['instanceID', 'DiskReadOps', 'DiskWriteOps', 'CPU_Util', 'DiskReadBytes', 'DiskWriteBytes', 'StatusCheckFailed']
-       ec2_metrics_df = pd.DataFrame.from_records(list(instance[2] for instance in orphan_instances), columns=ec2_headers)
-       ec2_metrics_df.to_excel(writer, sheet_name='EC2', index=False)
-
-       vol_headers = ['volumeID', 'Attachment-date', 'ReadOps', 'WriteOps', 'IdleTime', 'BurstBalance']
-       vol_metrics_df = pd.DataFrame.from_records(list(volume[2] for volume in orphan_volumes), columns=vol_headers)
-       vol_metrics_df.to_excel(writer, sheet_name='VOLUMES', index=False)
-
-       rds_headers = ['rdsID', 'Status', 'ARN', 'Tags', 'DBConnections', 'ReadLatency', 'WriteLatency', 'BurstBalance', 'FreeableMem', 'FreeStorageSpace', 'cpuSurplus', 'ebsByteBalance', 'ebsIOBalance']
-       rds_metrics_df = pd.DataFrame.from_records(list(db[2] for db in orphan_databases), columns=rds_headers)
-       rds_metrics_df.to_excel(writer, sheet_name='RDS', index=False)
-
-       ip_addresses = [(str(ip), 'available') for ip in orphaned_eips]
-       eip_metrics_df = pd.DataFrame(ip_addresses, columns=['EIP','Status'])
-       eip_metrics_df.to_excel(writer, sheet_name='EIP', index=False)
-
-       elb_headers = ['elbID', 'HealthyHostCount', 'RequestCount']
-       elb_metrics_df = pd.DataFrame.from_records(list(elb[2] for elb in orphaned_lbs), columns=elb_headers)
-       elb_metrics_df.to_excel(writer, sheet_name='ELB', index=False)
-
-       writer._save()
-
-    add_to_excel()
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import contextlib
+import contextvars
+import time
+from prometheus_client import Counter, Gauge, Histogram
+from rate_limit import throttling_error_codes
+
+
+# Accounting of what the scanner itself does. Every client the project
+# creates gets botocore event handlers that record its calls, attempts,
+# latency, throttles and bytes received, labelled with the detector that made
+# them. The detector is carried in a context variable, which follows the
+# thread running the detector and every asyncio task it starts.
+# GetMetricData requests shared by several detectors through the query
+# planner are labelled detector="planner".
+
+current_detector = contextvars.ContextVar('current_detector', default='scan')
+
+api_calls_metric = Counter(
+    'aws_api_calls',
+    'AWS API calls made, retries included in one call',
+    ['service', 'operation', 'detector', 'outcome']
+)
+
+api_call_seconds_metric = Histogram(
+    'aws_api_call_seconds',
+    'Latency of AWS API calls, retries and rate limiting waits included',
+    ['service', 'operation', 'detector'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+api_attempts_metric = Counter(
+    'aws_api_attempts',
+    'HTTP requests sent to AWS, one per attempt',
+    ['service', 'operation', 'detector', 'status']
+)
+
+api_retries_metric = Counter(
+    'aws_api_retries',
+    'Attempts of AWS API calls beyond the first',
+    ['service', 'operation', 'detector']
+)
+
+api_throttled_metric = Counter(
+    'aws_api_throttled_responses',
+    'Throttling errors returned by AWS',
+    ['service', 'operation', 'detector']
+)
+
+api_response_bytes_metric = Counter(
+    'aws_api_response_bytes',
+    'Bytes of response bodies received from AWS',
+    ['service', 'operation', 'detector']
+)
+
+phase_seconds_metric = Histogram(
+    'scan_phase_seconds',
+    'Duration of detector phases',
+    ['detector'],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+
+phase_last_seconds_metric = Gauge(
+    'scan_phase_last_seconds',
+    'Duration of the last run of each detector phase',
+    ['detector']
+)
+
+
+@contextlib.contextmanager
+def detector_context(name):
+    # Calls made inside are accounted to the detector
+    token = current_detector.set(name)
+    try:
+        yield
+    finally:
+        current_detector.reset(token)
+
+
+def observe_phase(name, elapsed):
+    phase_seconds_metric.labels(name).observe(elapsed)
+    phase_last_seconds_metric.labels(name).set(elapsed)
+
+
+def operation_labels(event_name):
+    # Event names end in <service id>.<operation>
+    service, operation = event_name.split('.')[-2:]
+    return service, operation, current_detector.get()
+
+
+def start_call(context, **kwargs):
+    context['instrumentation_started'] = time.perf_counter()
+
+
+def finish_call(event_name, context, outcome, retries=0):
+    labels = operation_labels(event_name)
+    api_calls_metric.labels(*labels, outcome).inc()
+    started = context.get('instrumentation_started')
+    if started is not None:
+        api_call_seconds_metric.labels(*labels).observe(time.perf_counter() - started)
+    if retries:
+        api_retries_metric.labels(*labels).inc(retries)
+
+
+def after_call(event_name, parsed, context, **kwargs):
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) if parsed else 0
+    finish_call(event_name, context, 'success', retries)
+
+
+def after_call_error(event_name, context, **kwargs):
+    finish_call(event_name, context, 'error')
+
+
+def response_received(event_name, response_dict, parsed_response, exception, **kwargs):
+    labels = operation_labels(event_name)
+    status = str(response_dict['status_code']) if response_dict else type(exception).__name__
+    api_attempts_metric.labels(*labels, status).inc()
+
+    if response_dict:
+        body = response_dict.get('body')
+        if isinstance(body, (bytes, bytearray)):
+            api_response_bytes_metric.labels(*labels).inc(len(body))
+    if parsed_response and parsed_response.get('Error', {}).get('Code') in throttling_error_codes:
+        api_throttled_metric.labels(*labels).inc()
+
+
+def register_instrumentation(client):
+    events = client.meta.events
+    service_id = client.meta.service_model.service_id.hyphenize()
+
+    # before-parameter-build is the first event of every call, and unlike
+    # before-call it cannot be short-circuited by another handler
+    events.register('before-parameter-build.{}'.format(service_id), start_call)
+    events.register('after-call.{}'.format(service_id), after_call)
+    events.register('after-call-error.{}'.format(service_id), after_call_error)
+    events.register('response-received.{}'.format(service_id), response_received)
@@ -0,0 +1,148 @@
+import threading
+from clients import get_client
+from query_planner import MetricPlanner
+
+
+# Each describe_* call is read through its paginator and handed on one page
+# at a time, so callers only ever hold a single page of resources in memory.
+
+def iter_pages(client, operation, result_key, **kwargs):
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        yield page.get(result_key, [])
+
+
+def iter_instance_pages(ec2_client):
+    for reservations in iter_pages(ec2_client, 'describe_instances', 'Reservations'):
+        yield [instance for reservation in reservations for instance in reservation['Instances']]
+
+
+def iter_volume_pages(ec2_client):
+    return iter_pages(ec2_client, 'describe_volumes', 'Volumes')
+
+
+def iter_db_instance_pages(rds_client):
+    return iter_pages(rds_client, 'describe_db_instances', 'DBInstances')
+
+
+def iter_load_balancer_pages(elbv2_client):
+    return iter_pages(elbv2_client, 'describe_load_balancers', 'LoadBalancers')
+
+
+def iter_address_pages(ec2_client):
+    # describe_addresses is not paginated by AWS, it always returns every address
+    yield ec2_client.describe_addresses().get('Addresses', [])
+
+
+# Maps a collection name to the client it is read with and its page iterator
+collections = {
+    'instances': ('ec2', iter_instance_pages),
+    'volumes': ('ec2', iter_volume_pages),
+    'db_instances': ('rds', iter_db_instance_pages),
+    'load_balancers': ('elbv2', iter_load_balancer_pages),
+    'addresses': ('ec2', iter_address_pages),
+}
+
+# Collections read by more than one detector (EC2 and EIP both walk the
+# instances); every other collection is streamed straight to its detector
+shared_collections = {'instances'}
+
+
+class PageCache:
+    # Pages of a shared collection, kept as they arrive. Each consumer
+    # replays the pages already described and then either describes the
+    # next page itself or waits for the consumer describing it, so every
+    # consumer starts on the first page without waiting for the last.
+
+    def __init__(self, source):
+        self.source = source
+        self.pages = []
+        self.done = False
+        self.error = None
+        self.fetching = False
+        self.condition = threading.Condition()
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.pages) and self.fetching:
+                    self.condition.wait()
+                if self.error:
+                    raise self.error
+                if index >= len(self.pages) and self.done:
+                    return
+                fetch = index >= len(self.pages)
+                if fetch:
+                    self.fetching = True
+                else:
+                    page = self.pages[index]
+
+            if fetch:
+                page = self._fetch()
+                if page is None:
+                    return
+            yield page
+            index += 1
+
+    def _fetch(self):
+        # Called by the one consumer that set fetching; describes the next
+        # page without holding the condition
+        try:
+            page = next(self.source)
+        except StopIteration:
+            page = None
+        except Exception as error:
+            with self.condition:
+                self.error = error
+                self.fetching = False
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            if page is None:
+                self.done = True
+            else:
+                self.pages.append(page)
+            self.fetching = False
+            self.condition.notify_all()
+        return page
+
+
+class InventorySnapshot:
+    # Scan scoped view of the inventory. A collection shared by several
+    # detectors is described once, page by page as the first of them reads
+    # it, and the others replay the same pages instead of issuing their own
+    # describe_* calls. The other collections are streamed, so their
+    # detectors only ever hold one page.
+
+    def __init__(self, region_name, profile=None, account_id=None):
+        self.region_name = region_name
+        self.profile = profile
+        self.account_id = account_id
+        self._pages = dict()
+        self._pages_lock = threading.Lock()
+        self._metric_planner = None
+        self._metric_planner_lock = threading.Lock()
+
+    def client(self, service):
+        # Clients come from the shared pool, keyed by this snapshot's target
+        return get_client(service, profile=self.profile, region=self.region_name)
+
+    def pages(self, name):
+        service, iter_collection_pages = collections[name]
+        if name not in shared_collections:
+            return iter_collection_pages(self.client(service))
+
+        with self._pages_lock:
+            if name not in self._pages:
+                self._pages[name] = PageCache(iter(iter_collection_pages(self.client(service))))
+            return self._pages[name]
+
+    def metric_planner(self):
+        # Every detector of the scan shares one planner, and so one window
+        # and one stream of GetMetricData requests
+        with self._metric_planner_lock:
+            if self._metric_planner is None:
+                self._metric_planner = MetricPlanner(self.client('cloudwatch'))
+            return self._metric_planner
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from config import load_config
+from prometheus_client import Counter
+
+
+# Load the config file
+config = load_config()
+
+metric_cache_enabled = config.get('metric_cache', False)
+metric_cache_path = config.get('metric_cache_path', 'metric_cache.db')
+metric_cache_max_entries = config.get('metric_cache_max_entries', 1000000)
+
+metric_cache_hits = Counter('metric_cache_hits', 'CloudWatch series served from the local cache')
+metric_cache_misses = Counter('metric_cache_misses', 'CloudWatch series fetched because they were not cached')
+
+
+# Local cache of CloudWatch series keyed by the query (namespace, metric,
+# dimensions, statistic, period, unit) and its time window. Scans ask for
+# the window of query_planner.scan_window, aligned to metric_window_align, so
+# every scan inside the same alignment period hits the cache. Callers store
+# entries expiring once the next boundary has passed, and the least recently
+# used entries are evicted beyond metric_cache_max_entries.
+
+
+def cache_key(query, start_time, end_time):
+    key = json.dumps([query, start_time.isoformat(), end_time.isoformat()], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class MetricCache:
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS series ('
+            'key TEXT PRIMARY KEY, vals TEXT, expires_at REAL, last_used REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS series_last_used ON series (last_used)')
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, queries, start_time, end_time):
+        # Returns the cached values by query key, and the queries still missing
+        keys = {query_key: cache_key(query, start_time, end_time) for query_key, query in queries.items()}
+        now = time.time()
+
+        cached = dict()
+        with self.lock:
+            digests = list(keys.values())
+            for offset in range(0, len(digests), 500):
+                chunk = digests[offset:offset + 500]
+                cursor = self.connection.execute(
+                    'SELECT key, vals FROM series WHERE expires_at > ? AND key IN ({})'.format(','.join('?' * len(chunk))),
+                    [now] + chunk
+                )
+                cached.update((row[0], json.loads(row[1])) for row in cursor)
+
+            self.connection.executemany('UPDATE series SET last_used = ? WHERE key = ?', [(now, key) for key in cached])
+            self.connection.commit()
+
+        results = dict()
+        missing = dict()
+        for query_key, digest in keys.items():
+            if digest in cached:
+                results[query_key] = cached[digest]
+            else:
+                missing[query_key] = queries[query_key]
+
+        self.hits += len(results)
+        self.misses += len(missing)
+        metric_cache_hits.inc(len(results))
+        metric_cache_misses.inc(len(missing))
+        return results, missing
+
+    def store(self, queries, results, start_time, end_time, expires_at):
+        now = time.time()
+        records = [
+            (cache_key(query, start_time, end_time), json.dumps(results[query_key]), expires_at, now)
+            for query_key, query in queries.items()
+        ]
+
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?)', records)
+            self.connection.execute('DELETE FROM series WHERE expires_at <= ?', [now])
+
+            # Evict the least recently used series beyond the size bound
+            count = self.connection.execute('SELECT COUNT(*) FROM series').fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    'DELETE FROM series WHERE key IN (SELECT key FROM series ORDER BY last_used LIMIT ?)',
+                    [count - self.max_entries]
+                )
+            self.connection.commit()
+
+
+metric_cache = MetricCache(metric_cache_path, metric_cache_max_entries) if metric_cache_enabled else None
@@ -0,0 +1,56 @@
+# GetMetricData accepts at most 500 metric queries per request
+MAX_QUERIES_PER_REQUEST = 500
+
+
+def metric_stat(namespace, metric_name, dimension_name, dimension_value, stat, period, unit=None):
+    metric_stat = {
+        'Metric': {
+            'Namespace': namespace,
+            'MetricName': metric_name,
+            'Dimensions': [{'Name': dimension_name, 'Value': dimension_value}]
+        },
+        'Period': period,
+        'Stat': stat
+    }
+    if unit:
+        metric_stat['Unit'] = unit
+    return metric_stat
+
+
+def build_metric_data_requests(queries, start_time, end_time):
+    # queries maps a caller chosen key to a MetricStat dict (see metric_stat).
+    # Yields one GetMetricData request per 500 queries, with the query ids
+    # mapped back to their keys.
+    keys = list(queries)
+
+    for offset in range(0, len(keys), MAX_QUERIES_PER_REQUEST):
+        chunk = keys[offset:offset + MAX_QUERIES_PER_REQUEST]
+
+        # Query ids must start with a lowercase letter, so map them back by position
+        ids = {'m{}'.format(index): key for index, key in enumerate(chunk)}
+        metric_queries = [
+            {'Id': query_id, 'MetricStat': queries[key], 'ReturnData': True}
+            for query_id, key in ids.items()
+        ]
+
+        kwargs = dict(
+            MetricDataQueries=metric_queries,
+            StartTime=start_time,
+            EndTime=end_time,
+            ScanBy='TimestampDescending'
+        )
+        yield ids, kwargs
+
+
+def collect_metric_data(results, ids, response):
+    for result in response['MetricDataResults']:
+        results[ids[result['Id']]].extend(result.get('Values', []))
+
+
+def first_value(values, default=0):
+    return values[0] if values else default
+
+
+def average_value(values, default=0):
+    return sum(values) / len(values) if values else default
+
@@ -0,0 +1,241 @@
+import os
+import re
+import threading
+import time
+import numpy as np
+from config import load_config
+from records import schemas
+from result_sink import text_columns
+
+
+# Load the config file
+config = load_config()
+
+metric_history_enabled = config.get('metric_history', False)
+metric_history_path = config.get('metric_history_path', 'metric_history')
+metric_history_retention_days = config.get('metric_history_retention_days', 90)
+
+
+# Local history of the metrics every scan evaluated. Each resource type has
+# a directory of append-only column files: the time each row was recorded,
+# the index of its resource, and one float32 file per numeric metric column,
+# plus resources.txt whose line numbers are the resource indexes. Appending
+# a scan writes only its own rows. Queries memory-map the columns, find the
+# start of the window with a binary search (rows are recorded in time
+# order) and aggregate per resource with NumPy, without any CloudWatch call.
+#
+# Rules read rolling windows through columns named
+# <metric>_<max|min|mean|sum|count>_<days>d, e.g. CPU_Util_max_30d.
+
+history_column = re.compile(r'^(?P<metric>.+)_(?P<statistic>max|min|mean|sum|count)_(?P<days>\d+)d$')
+
+time_dtype = np.dtype('<u4')
+resource_dtype = np.dtype('<u4')
+value_dtype = np.dtype('<f4')
+
+
+def numeric_columns(resource_type):
+    return [column for column in schemas.get(resource_type, ()) if column not in text_columns]
+
+
+def column_value(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return np.nan
+
+
+class HistoryColumns:
+    # The column files of one resource type
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._finish_expiry()
+
+        index_path = os.path.join(path, 'resources.txt')
+        self.index = dict()
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                for line in index_file:
+                    self.index[line.rstrip('\n')] = len(self.index)
+
+        # A crash between two column appends leaves columns of different
+        # lengths; rows past the shortest one are ignored and overwritten
+        lengths = {
+            name: os.path.getsize(self.file(name)) // dtype.itemsize
+            for name, dtype in self.files() if os.path.exists(self.file(name))
+        }
+        self.rows = min(lengths.values()) if 'time' in lengths and 'resource' in lengths else 0
+        for name, dtype in self.files():
+            if name in lengths:
+                os.truncate(self.file(name), self.rows * dtype.itemsize)
+            else:
+                # A metric column new to the schema has no values for the
+                # rows recorded before it, rather than cutting the others
+                np.full(self.rows, np.nan, dtype).tofile(self.file(name))
+
+    def marker(self):
+        return os.path.join(self.path, 'expiring')
+
+    def _finish_expiry(self):
+        # An expiry writes every column to a .tmp file first and only then
+        # creates the marker, so a crash before it leaves the old columns
+        # whole and a crash after it leaves whole new ones to swap in
+        if os.path.exists(self.marker()):
+            for name, dtype in self.files():
+                if os.path.exists(self.file(name) + '.tmp'):
+                    os.replace(self.file(name) + '.tmp', self.file(name))
+            os.remove(self.marker())
+        for name, dtype in self.files():
+            if os.path.exists(self.file(name) + '.tmp'):
+                os.remove(self.file(name) + '.tmp')
+
+    def files(self):
+        return [('time', time_dtype), ('resource', resource_dtype)] + [(column, value_dtype) for column in self.columns]
+
+    def file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def column(self, name, dtype, rows):
+        if not rows:
+            return np.zeros(0, dtype)
+        return np.memmap(self.file(name), dtype=dtype, mode='r', shape=(rows,))
+
+    def append(self, all_metrics):
+        # all_metrics maps resource ids to their metrics dict
+        if not all_metrics:
+            return
+        ids = list(all_metrics)
+
+        with self.lock:
+            new_ids = [resource_id for resource_id in ids if resource_id not in self.index]
+            if new_ids:
+                with open(os.path.join(self.path, 'resources.txt'), 'a') as index_file:
+                    index_file.writelines(resource_id + '\n' for resource_id in new_ids)
+                for resource_id in new_ids:
+                    self.index[resource_id] = len(self.index)
+
+            # Rows are stamped under the lock, so the time column stays sorted
+            now = int(time.time())
+            columns = {
+                'time': np.full(len(ids), now, time_dtype),
+                'resource': np.fromiter((self.index[resource_id] for resource_id in ids), resource_dtype, len(ids)),
+            }
+            for column in self.columns:
+                columns[column] = np.fromiter(
+                    (column_value(all_metrics[resource_id].get(column)) for resource_id in ids), value_dtype, len(ids)
+                )
+
+            for name, dtype in self.files():
+                with open(self.file(name), 'ab') as column_file:
+                    column_file.write(columns[name].tobytes())
+            self.rows += len(ids)
+
+            self._expire(now)
+
+    def _expire(self, now):
+        # Rows older than the retention are dropped, at most once a day
+        times = self.column('time', time_dtype, self.rows)
+        oldest = now - metric_history_retention_days * 86400
+        if not self.rows or times[0] >= oldest - 86400:
+            return
+
+        keep_from = int(np.searchsorted(times, oldest, 'left'))
+        for name, dtype in self.files():
+            with open(self.file(name) + '.tmp', 'wb') as column_file:
+                self.column(name, dtype, self.rows)[keep_from:].tofile(column_file)
+                column_file.flush()
+                os.fsync(column_file.fileno())
+        with open(self.marker(), 'w'):
+            pass
+        self._finish_expiry()
+        self.rows -= keep_from
+
+    def rolling(self, metric, resource_ids, days, statistic, now=None):
+        # Returns the statistic of metric over the last days for every id in
+        # resource_ids, NaN where the history has no values
+        result = np.full(len(resource_ids), np.nan)
+        if metric not in self.columns or not len(resource_ids):
+            return result
+
+        with self.lock:
+            rows = self.rows
+            if not rows:
+                return result
+            indexes = np.array([self.index.get(resource_id, -1) for resource_id in resource_ids], np.int64)
+            resources_known = len(self.index)
+            # Mapped under the lock, so an expiry rewriting the files cannot shrink them underneath
+            times = self.column('time', time_dtype, rows)
+            resources = self.column('resource', resource_dtype, rows)
+            values = self.column(metric, value_dtype, rows)
+
+        since = (now or time.time()) - days * 86400
+        start = int(np.searchsorted(times, since, 'left'))
+        resources = resources[start:].astype(np.int64)
+        values = values[start:].astype(np.float64)
+
+        present = ~np.isnan(values)
+        resources, values = resources[present], values[present]
+        counts = np.bincount(resources, minlength=resources_known)
+
+        if statistic == 'count':
+            per_resource = counts.astype(np.float64)
+        elif statistic in ('sum', 'mean'):
+            per_resource = np.bincount(resources, weights=values, minlength=resources_known)
+            if statistic == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    per_resource = per_resource / counts
+        else:
+            per_resource = np.full(resources_known, -np.inf if statistic == 'max' else np.inf)
+            (np.maximum if statistic == 'max' else np.minimum).at(per_resource, resources, values)
+
+        known = indexes >= 0
+        result[known] = per_resource[indexes[known]]
+        # Resources without a single value in the window have no statistic
+        if statistic != 'count':
+            result[known & (counts[np.maximum(indexes, 0)] == 0)] = np.nan
+        return result
+
+
+class MetricHistory:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.types = dict()
+
+    def columns(self, resource_type):
+        with self.lock:
+            if resource_type not in self.types:
+                self.types[resource_type] = HistoryColumns(
+                    os.path.join(self.path, resource_type.replace(' ', '_')), numeric_columns(resource_type)
+                )
+            return self.types[resource_type]
+
+
+metric_history = MetricHistory(metric_history_path) if metric_history_enabled else None
+
+
+def record_history(resource_type, all_metrics):
+    if metric_history:
+        metric_history.columns(resource_type).append(all_metrics)
+
+
+def rolling_metric(resource_type, metric, resource_ids, days, statistic):
+    if not metric_history:
+        return np.full(len(resource_ids), np.nan)
+    return metric_history.columns(resource_type).rolling(metric, resource_ids, days, statistic)
+
+
+def add_history_columns(resource_type, resource_ids, records, columns):
+    # Fills in the columns named like CPU_Util_max_30d that the rules read,
+    # records being the rule engine's dicts in resource_ids order
+    for column in columns:
+        match = history_column.match(column)
+        if not match:
+            continue
+        values = rolling_metric(resource_type, match['metric'], resource_ids, int(match['days']), match['statistic'])
+        for record, value in zip(records, values.tolist()):
+            record[column] = value
@@ -0,0 +1,51 @@
+import collections
+import concurrent.futures
+import time
+import traceback
+from instrumentation import detector_context, observe_phase
+from profiling import profile_phase
+from result_sink import target_context
+
+
+# Outcome of one detector phase of a scan
+PhaseResult = collections.namedtuple('PhaseResult', ['name', 'result', 'error', 'elapsed'])
+
+
+def run_detector(name, detector, snapshot):
+    start = time.perf_counter()
+    try:
+        # AWS calls made by the detector are labelled with its name, the rows
+        # it writes with its target, and the phase is profiled when
+        # profiling mode is on
+        with detector_context(name), target_context(snapshot.account_id, snapshot.region_name), profile_phase(name):
+            result = detector(snapshot)
+        error = None
+    except Exception as e:
+        # A failing detector must not take the rest of the scan down with it
+        print("\n{} detector failed:".format(name))
+        traceback.print_exc()
+        result = set()
+        error = e
+    elapsed = time.perf_counter() - start
+    observe_phase(name, elapsed)
+
+    print("\n{} detector finished in {:.2f}s".format(name, elapsed))
+    return PhaseResult(name, result, error, elapsed)
+
+
+def run_detectors(detectors, snapshot, parallel=True, max_workers=5):
+    # detectors maps a phase name to a detector function taking the snapshot
+    start = time.perf_counter()
+
+    if parallel:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(run_detector, name, detector, snapshot)
+                for name, detector in detectors.items()
+            }
+            results = {name: future.result() for name, future in futures.items()}
+    else:
+        results = {name: run_detector(name, detector, snapshot) for name, detector in detectors.items()}
+
+    print("\nScan finished in {:.2f}s".format(time.perf_counter() - start))
+    return results
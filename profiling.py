@@ -0,0 +1,153 @@
+import collections
+import contextlib
+import cProfile
+import datetime
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from config import load_config
+
+
+# Load the config file
+config = load_config()
+
+profiling = config.get('profiling', False)
+profile_dir = config.get('profile_dir', 'profiles')
+profile_sample_interval = config.get('profile_sample_interval', 0.005)
+profile_tracemalloc_frames = config.get('profile_tracemalloc_frames', 10)
+profile_top_allocations = config.get('profile_top_allocations', 50)
+
+
+# Profiling mode. Every detector phase gets a deterministic cProfile of its
+# thread, a sampled stack profile in collapsed format for flame graphs, and
+# the allocations it made according to tracemalloc. Each run of a phase
+# writes <profile_dir>/<timestamp>-<phase>.prof, .collapsed and .alloc.txt.
+
+def enable_profiling():
+    global profiling
+    profiling = True
+
+
+class StackSampler:
+    # Samples the stacks of registered threads with sys._current_frames and
+    # counts them per phase, root frame first, as flame graph tools expect
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # thread ident -> Counter of collapsed stacks
+        self.threads = dict()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self.thread.start()
+
+    def register(self, ident):
+        stacks = collections.Counter()
+        with self.lock:
+            self.threads[ident] = stacks
+        return stacks
+
+    def unregister(self, ident):
+        with self.lock:
+            return self.threads.pop(ident, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.threads:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self.threads.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name).replace(' ', '_')
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+sampler = StackSampler(profile_sample_interval)
+
+
+def profile_path(stamp, name, extension):
+    return os.path.join(profile_dir, '{}-{}.{}'.format(stamp, name.replace(' ', '_'), extension))
+
+
+def write_collapsed(path, stacks):
+    with open(path, 'w') as collapsed_file:
+        for stack, count in stacks.most_common():
+            collapsed_file.write('{} {}\n'.format(stack, count))
+
+
+def write_allocations(path, name, before, after, elapsed):
+    # tracemalloc is process wide: when phases run concurrently, allocations
+    # of the other phases running at the same time are included too
+    statistics = after.compare_to(before, 'lineno')
+    current, peak = tracemalloc.get_traced_memory()
+    with open(path, 'w') as alloc_file:
+        alloc_file.write('{} phase, {:.2f}s\n'.format(name, elapsed))
+        alloc_file.write('traced memory {:.1f} MiB, peak {:.1f} MiB\n\n'.format(current / 2**20, peak / 2**20))
+        for statistic in statistics[:profile_top_allocations]:
+            alloc_file.write('{}\n'.format(statistic))
+
+
+@contextlib.contextmanager
+def profile_phase(name):
+    if not profiling:
+        yield
+        return
+
+    os.makedirs(profile_dir, exist_ok=True)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(profile_tracemalloc_frames)
+    ignored = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, __file__),
+    ]
+    before = tracemalloc.take_snapshot().filter_traces(ignored)
+
+    ident = threading.get_ident()
+    sampler.start()
+    stacks = sampler.register(ident)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one active cProfile per process, concurrent
+        # phases then only get the sampled stacks
+        profiler = None
+
+    # The files of one run of a phase share the time it started
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path(stamp, name, 'prof'))
+        sampler.unregister(ident)
+        write_collapsed(profile_path(stamp, name, 'collapsed'), stacks)
+        after = tracemalloc.take_snapshot().filter_traces(ignored)
+        write_allocations(profile_path(stamp, name, 'alloc.txt'), name, before, after, elapsed)
+        print("\nWrote {} profile to {}".format(name, profile_dir))
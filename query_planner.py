@@ -0,0 +1,195 @@
+import collections
+import datetime
+import threading
+import time
+from config import load_config
+from fleet_metrics import FleetMetrics, metric_fleet_queries
+from instrumentation import detector_context
+from metric_cache import metric_cache
+from metric_data import MAX_QUERIES_PER_REQUEST, build_metric_data_requests, collect_metric_data
+from prometheus_client import Counter
+
+
+# Load the config file
+config = load_config()
+
+metric_window_hours = config.get('metric_window_hours', 24)
+metric_window_align = config.get('metric_window_align', 3600)
+metric_batch_linger = config.get('metric_batch_linger', 0.05)
+metric_aggregation = config.get('metric_aggregation', 'window')
+
+planned_queries_metric = Counter(
+    'metric_planner_queries',
+    'Metric queries asked of the query planner, by how they were answered',
+    ['outcome']
+)
+
+
+# Query planner. Detectors declare the CloudWatch series they need and the
+# planner of their scan fetches them: every detector of a scan shares one
+# time window, identical series asked for by several callers are fetched
+# once, and the queries of every detector are packed together into full
+# GetMetricData requests instead of each page sending its own part-filled
+# ones. A caller whose queries are waiting in a part-filled request sends it
+# once metric_batch_linger has passed without it filling up.
+#
+# In window aggregation mode every series is asked for with one period
+# spanning the whole window, so CloudWatch reduces it server side and sends
+# back a single datapoint per resource and statistic, the value the checks
+# read. Series mode keeps each query's own period and returns every
+# datapoint of the window.
+
+aggregation_modes = ('window', 'series')
+
+def scan_window(hours=None, align=None, now=None):
+    # The window of one scan, ending on the last align boundary so that scans
+    # started within the same period ask for the same datapoints
+    hours = metric_window_hours if hours is None else hours
+    align = metric_window_align if align is None else align
+    epoch = (now or datetime.datetime.utcnow()).replace(tzinfo=datetime.timezone.utc).timestamp()
+    end_time = datetime.datetime.utcfromtimestamp(epoch - epoch % align)
+    return end_time - datetime.timedelta(hours=hours), end_time
+
+
+def window_period(start_time, end_time):
+    # Periods are whole minutes
+    return max(60, int((end_time - start_time).total_seconds()) // 60 * 60)
+
+
+def aggregate_queries(queries, start_time, end_time, aggregation=None):
+    aggregation = aggregation or metric_aggregation
+    if aggregation not in aggregation_modes:
+        raise ValueError("Unknown metric aggregation {!r}, expected one of {}".format(aggregation, ', '.join(aggregation_modes)))
+    if aggregation == 'series':
+        return queries
+
+    period = window_period(start_time, end_time)
+    return {key: dict(query, Period=period) for key, query in queries.items()}
+
+
+def series_id(query):
+    # Queries for the same series are equal MetricStat dicts
+    metric = query['Metric']
+    dimensions = tuple((dimension['Name'], dimension['Value']) for dimension in metric['Dimensions'])
+    return metric['Namespace'], metric['MetricName'], dimensions, query['Stat'], query['Period'], query.get('Unit')
+
+
+class MetricPlanner:
+
+    def __init__(self, cloudwatch_client, window=None, linger=None, aggregation=None):
+        self.cloudwatch_client = cloudwatch_client
+        self.start_time, self.end_time = window or scan_window()
+        self.linger = metric_batch_linger if linger is None else linger
+        self.aggregation = aggregation or metric_aggregation
+        # Metrics Insights fleet queries answer what they can before any per
+        # resource query is planned
+        self.fleet = FleetMetrics(cloudwatch_client, self.start_time, self.end_time) if metric_fleet_queries else None
+        self.condition = threading.Condition()
+        # series id -> MetricStat of the series no request has taken yet
+        self.pending = collections.OrderedDict()
+        # series id -> values, kept while some caller still waits for them
+        self.series = dict()
+        # series id -> number of callers waiting for it
+        self.waiting = collections.Counter()
+
+    def get(self, queries):
+        # queries maps a caller chosen key to a MetricStat dict (see
+        # metric_stat); returns the keys mapped to their values, newest first
+        queries = aggregate_queries(queries, self.start_time, self.end_time, self.aggregation)
+        answered = dict()
+        if self.fleet:
+            with detector_context('planner'):
+                answered, queries = self.fleet.split(queries)
+            planned_queries_metric.labels('fleet').inc(len(answered))
+
+        ids = {key: series_id(query) for key, query in queries.items()}
+        wanted = set(ids.values())
+        queries_by_id = {ids[key]: query for key, query in queries.items()}
+
+        with self.condition:
+            # Series another caller already asked for are not asked again
+            new = {series: queries_by_id[series] for series in wanted if series not in self.waiting}
+            self.waiting.update(wanted)
+        planned_queries_metric.labels('deduplicated').inc(len(queries) - len(new))
+
+        try:
+            self._plan(new)
+            results = self._wait(wanted, ids)
+            results.update(answered)
+            return results
+        finally:
+            with self.condition:
+                self.waiting.subtract(wanted)
+                for series in wanted:
+                    if self.waiting[series] <= 0:
+                        del self.waiting[series]
+                        self.series.pop(series, None)
+
+    def _plan(self, new):
+        cached = dict()
+        if metric_cache and new:
+            cached, new = metric_cache.lookup(new, self.start_time, self.end_time)
+        planned_queries_metric.labels('cached').inc(len(cached))
+
+        with self.condition:
+            self.series.update(cached)
+            self.pending.update(new)
+            self.condition.notify_all()
+
+    def _wait(self, wanted, ids):
+        deadline = time.monotonic() + self.linger
+        with self.condition:
+            while not all(series in self.series for series in wanted):
+                now = time.monotonic()
+                queued = any(series in self.pending for series in wanted)
+                if len(self.pending) >= MAX_QUERIES_PER_REQUEST or (queued and now >= deadline):
+                    self._send()
+                    continue
+                # Otherwise wait for the request to fill up, or for the
+                # callers sending our series to store them
+                self.condition.wait(deadline - now if queued else 1)
+
+            return {key: self.series[series] for key, series in ids.items()}
+
+    def _send(self):
+        # Called with the condition held; the request itself is sent without it
+        batch = collections.OrderedDict()
+        while self.pending and len(batch) < MAX_QUERIES_PER_REQUEST:
+            series, query = self.pending.popitem(last=False)
+            batch[series] = query
+
+        self.condition.release()
+        try:
+            # A request carries the series of every detector, so its calls
+            # are accounted to the planner rather than to whichever detector
+            # thread happened to send it
+            with detector_context('planner'):
+                fetched = self._fetch(batch)
+        except Exception:
+            self.condition.acquire()
+            # Put the series back, so the next caller waiting for them retries
+            self.pending.update(batch)
+            self.condition.notify_all()
+            raise
+        self.condition.acquire()
+
+        self.series.update((series, values) for series, values in fetched.items() if series in self.waiting)
+        self.condition.notify_all()
+
+    def _fetch(self, batch):
+        results = {series: [] for series in batch}
+        for ids, kwargs in build_metric_data_requests(batch, self.start_time, self.end_time):
+            while True:
+                response = self.cloudwatch_client.get_metric_data(**kwargs)
+                collect_metric_data(results, ids, response)
+
+                next_token = response.get('NextToken')
+                if not next_token:
+                    break
+                kwargs['NextToken'] = next_token
+        planned_queries_metric.labels('fetched').inc(len(batch))
+
+        if metric_cache:
+            expires_at = self.end_time.replace(tzinfo=datetime.timezone.utc).timestamp() + metric_window_align
+            metric_cache.store(batch, results, self.start_time, self.end_time, expires_at)
+        return results
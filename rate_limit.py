@@ -0,0 +1,136 @@
+import asyncio
+import random
+import threading
+import time
+from config import load_config
+from prometheus_client import Counter, Gauge
+
+
+# Load the config file
+config = load_config()
+
+rate_limit_default = config.get('rate_limit_default', 20)
+rate_limit_min = config.get('rate_limit_min', 1)
+rate_limit_max = config.get('rate_limit_max', 100)
+rate_limit_increase = config.get('rate_limit_increase', 0.5)
+rate_limit_decrease = config.get('rate_limit_decrease', 0.5)
+rate_limits = config.get('rate_limits') or dict()
+
+# Error codes AWS uses to say a caller is over its request quota
+throttling_error_codes = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+}
+
+api_rate_metric = Gauge(
+    'aws_api_rate_limit',
+    'Current allowed requests per second',
+    ['profile', 'region', 'operation']
+)
+
+api_throttles_metric = Counter(
+    'aws_api_throttles',
+    'Throttling responses received',
+    ['profile', 'region', 'operation']
+)
+
+
+class TokenBucket:
+    # Token bucket whose refill rate follows AIMD: every successful request
+    # raises the rate a little, every throttling response halves it.
+
+    def __init__(self, rate, labels):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.labels = labels
+        self.lock = threading.Lock()
+        api_rate_metric.labels(*labels).set(rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Takes a token and returns 0, or returns how long until one is left
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            # Jitter keeps the threads sharing a bucket from waking in lockstep
+            time.sleep(wait + random.uniform(0, wait))
+
+    async def acquire_async(self):
+        # The asyncio engine waits without blocking the event loop
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait + random.uniform(0, wait))
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(rate_limit_max, self.rate + rate_limit_increase / self.rate)
+        api_rate_metric.labels(*self.labels).set(self.rate)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(rate_limit_min, self.rate * rate_limit_decrease)
+            # Drop any saved up burst so the lower rate applies straight away
+            self.tokens = min(self.tokens, 0)
+        api_rate_metric.labels(*self.labels).set(self.rate)
+        api_throttles_metric.labels(*self.labels).inc()
+
+
+buckets = dict()
+buckets_lock = threading.Lock()
+
+
+def get_bucket(profile, region, operation):
+    key = (profile or 'default', region, operation)
+    with buckets_lock:
+        if key not in buckets:
+            buckets[key] = TokenBucket(rate_limits.get(operation, rate_limit_default), key)
+        return buckets[key]
+
+
+def register_rate_limiter(client, profile, region, asynchronous=False):
+    # Every HTTP attempt of the client, retries included, waits for a token
+    # from the bucket of its (profile, region, operation). The buckets are
+    # shared by the threaded and the asyncio clients; aiobotocore awaits
+    # the handlers that are coroutines
+    service_id = client.meta.service_model.service_id.hyphenize()
+
+    def before_send(event_name, **kwargs):
+        get_bucket(profile, region, event_name.rsplit('.', 1)[-1]).acquire()
+
+    async def before_send_async(event_name, **kwargs):
+        await get_bucket(profile, region, event_name.rsplit('.', 1)[-1]).acquire_async()
+
+    def needs_retry(response, operation, **kwargs):
+        if response is None:
+            return
+        bucket = get_bucket(profile, region, operation.name)
+        http_response, parsed = response
+        if parsed.get('Error', {}).get('Code') in throttling_error_codes:
+            bucket.on_throttle()
+        elif http_response.status_code < 400:
+            bucket.on_success()
+
+    client.meta.events.register('before-send.{}'.format(service_id), before_send_async if asynchronous else before_send)
+    client.meta.events.register('needs-retry.{}'.format(service_id), needs_retry)
@@ -0,0 +1,49 @@
+# Orphans found by the detectors. An orphan keeps its metric values as a
+# tuple in the column order of its resource type instead of holding on to
+# the metrics dict it was built from, so a scan's results cost a small fixed
+# size per resource. Two records are the same orphan when they are the same
+# resource: sets of records dedupe by resource type and id.
+
+# Metric columns of every resource type, the keys of the metrics dicts the
+# detectors build
+schemas = {
+    'EC2': ('instanceID', 'DiskReadOps', 'DiskWriteOps', 'CPU_Util', 'DiskReadBytes', 'DiskWriteBytes', 'StatusCheckFailed'),
+    'VOLUME': ('VolumeID', 'ReadOps', 'WriteOps', 'IdleTime', 'BurstBalance', 'Attachment-date'),
+    'RDS': ('db_ID', 'DBConnections', 'ReadLatency', 'WriteLatency', 'BurstBalance', 'FreeableMem', 'FreeStorageSpace',
+            'cpuSurplus', 'ebsByteBalance', 'ebsIOBalance', 'Status', 'ARN', 'Tags'),
+    'ELB': ('elb_arn', 'HealthyHostCount', 'RequestCount'),
+    'Potential ELB': ('elb_arn', 'HealthyHostCount', 'RequestCount'),
+    'EIP': (),
+}
+
+
+class OrphanRecord:
+    __slots__ = ('resource_type', 'resource_id', 'values', 'reasons')
+
+    def __init__(self, resource_type, resource_id, values=(), reasons=()):
+        self.resource_type = resource_type
+        self.resource_id = resource_id
+        # Metric values in schemas[resource_type] order
+        self.values = values
+        # Names of the checks that matched
+        self.reasons = reasons
+
+    def metrics(self):
+        # (column, value) pairs of the metrics
+        return zip(schemas.get(self.resource_type, ()), self.values)
+
+    def __eq__(self, other):
+        if not isinstance(other, OrphanRecord):
+            return NotImplemented
+        return self.resource_type == other.resource_type and self.resource_id == other.resource_id
+
+    def __hash__(self):
+        return hash((self.resource_type, self.resource_id))
+
+    def __repr__(self):
+        return 'OrphanRecord({!r}, {!r}, {!r}, {!r})'.format(self.resource_type, self.resource_id, self.values, self.reasons)
+
+
+def orphan_record(resource_type, resource_id, metrics, reasons=()):
+    # Keeps only the values of a detector's metrics dict, in schema order
+    return OrphanRecord(resource_type, resource_id, tuple(map(metrics.get, schemas.get(resource_type, ()))), tuple(reasons))
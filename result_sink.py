@@ -0,0 +1,257 @@
+import atexit
+import contextlib
+import contextvars
+import csv
+import datetime
+import json
+import numbers
+import os
+import threading
+import time
+import traceback
+from config import load_config
+from prometheus_client import Counter
+from records import schemas
+from rules import orphan_severity
+
+
+# Load the config file
+config = load_config()
+
+sink_path = config.get('sink_path', 'orphaned')
+sink_format = config.get('sink_format', 'csv')
+sink_buffer_rows = config.get('sink_buffer_rows', 10000)
+sink_rotate_bytes = config.get('sink_rotate_bytes', 100 * 1024 * 1024)
+sink_rotate_seconds = config.get('sink_rotate_seconds', 86400)
+
+sink_errors_metric = Counter('orphan_sink_errors', 'Batches of orphans the result sink failed to write')
+
+
+# Every resource type is written to its own file with a fixed set of columns,
+# so each file loads straight into pandas, a spreadsheet or a warehouse. The
+# columns are the metric columns of the records, see records.schemas.
+
+# Columns every file starts and ends with
+leading_columns = ['account_id', 'region', 'resource_type', 'resource_id']
+trailing_columns = ['reasons', 'severity']
+
+# Columns holding text, every other column is numeric
+text_columns = set(leading_columns + trailing_columns + [
+    'instanceID', 'VolumeID', 'Attachment-date', 'db_ID', 'Status', 'ARN', 'Tags', 'elb_arn'
+])
+
+
+def columns(resource_type):
+    return leading_columns + list(schemas.get(resource_type, ())) + trailing_columns
+
+
+def orphan_row(record, account_id=None, region=None):
+    # Returns the resource type and the row of one orphan record, in schema order
+    values = list(record.values)
+    for index, value in enumerate(values):
+        if type(value) not in scalar_types:
+            values[index] = cell(value)
+    return record.resource_type, [account_id, region, record.resource_type, record.resource_id] + values + [
+        ';'.join(record.reasons), orphan_severity(record.resource_type, record.reasons)
+    ]
+
+
+# Types written as they are, without going through cell
+scalar_types = {str, int, float, bool, type(None)}
+
+def cell(value):
+    # Values that are not plain scalars are stored as JSON, never as a repr
+    if value is None or isinstance(value, (str, numbers.Number)):
+        return value
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return json.dumps(value, default=str)
+
+
+class CsvWriter:
+    extension = 'csv'
+
+    def __init__(self, path, fieldnames):
+        self.file = open(path, 'w', newline='', buffering=1024 * 1024)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(fieldnames)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlWriter:
+    extension = 'jsonl'
+
+    def __init__(self, path, fieldnames):
+        self.fieldnames = fieldnames
+        self.file = open(path, 'w', buffering=1024 * 1024)
+
+    def write(self, rows):
+        encode = json.JSONEncoder().encode
+        self.file.writelines(encode(dict(zip(self.fieldnames, row))) + '\n' for row in rows)
+        self.file.flush()
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    extension = 'parquet'
+
+    def __init__(self, path, fieldnames):
+        # pyarrow is only needed when the parquet format is selected
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.path = path
+        self.fieldnames = fieldnames
+        self.schema = pyarrow.schema([
+            (field, pyarrow.string() if field in text_columns else pyarrow.float64()) for field in fieldnames
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        # Every buffered batch becomes one row group
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(column, type=field.type) for column, field in zip(zip(*rows), self.schema)],
+            schema=self.schema
+        )
+        self.writer.write_table(table)
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.writer.close()
+
+
+writers = {
+    'csv': CsvWriter,
+    'jsonl': JsonlWriter,
+    'parquet': ParquetWriter,
+}
+
+
+class ResultSink:
+    # Buffers records per resource type and appends them to one open file per
+    # type, starting a new file once the current one is too big or too old
+
+    def __init__(self, base_path, format='csv', buffer_rows=10000, rotate_bytes=None, rotate_seconds=None):
+        if format not in writers:
+            raise ValueError("Unknown sink format {!r}, expected one of {}".format(format, ', '.join(writers)))
+        if format == 'parquet':
+            # Fail at startup rather than at the first flush of a scan
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                raise ValueError("sink_format parquet needs pyarrow, pip install -r requirements.txt")
+        self.base_path = base_path
+        self.writer_class = writers[format]
+        self.buffer_rows = buffer_rows
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.lock = threading.Lock()
+        self.buffers = dict()
+        # resource type -> (writer, opened at)
+        self.files = dict()
+
+    def path(self, resource_type):
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        name = resource_type.replace(' ', '_')
+        return '{}-{}-{}.{}'.format(self.base_path, name, stamp, self.writer_class.extension)
+
+    def write(self, orphans, account_id=None, region=None):
+        with self.lock:
+            for orphan in orphans:
+                resource_type, row = orphan_row(orphan, account_id, region)
+                buffer = self.buffers.setdefault(resource_type, [])
+                buffer.append(row)
+                if len(buffer) >= self.buffer_rows:
+                    self._flush(resource_type)
+
+    def _writer(self, resource_type):
+        writer, opened_at = self.files.get(resource_type, (None, None))
+        if writer is not None:
+            too_big = self.rotate_bytes and writer.size() >= self.rotate_bytes
+            too_old = self.rotate_seconds and time.time() - opened_at >= self.rotate_seconds
+            if too_big or too_old:
+                writer.close()
+                writer = None
+
+        if writer is None:
+            directory = os.path.dirname(self.base_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            writer = self.writer_class(self.path(resource_type), columns(resource_type))
+            self.files[resource_type] = (writer, time.time())
+        return writer
+
+    def _flush(self, resource_type):
+        buffer = self.buffers.pop(resource_type, None)
+        if buffer:
+            self._writer(resource_type).write(buffer)
+
+    def flush(self):
+        with self.lock:
+            for resource_type in list(self.buffers):
+                self._flush(resource_type)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for writer, opened_at in self.files.values():
+                writer.close()
+            self.files.clear()
+
+
+orphan_sink = ResultSink(sink_path, sink_format, sink_buffer_rows, sink_rotate_bytes, sink_rotate_seconds)
+atexit.register(orphan_sink.close)
+
+
+# Account and region of the target the current detector scans, stamped on
+# every row it writes
+current_target = contextvars.ContextVar('current_target', default=(None, None))
+
+
+@contextlib.contextmanager
+def target_context(account_id, region):
+    token = current_target.set((account_id, region))
+    try:
+        yield
+    finally:
+        current_target.reset(token)
+
+
+# A sink that cannot write, e.g. a full disk, loses its rows but does not
+# fail the detectors or keep a scan's results from the exporter and workbook
+
+def write_orphans(orphans):
+    account_id, region = current_target.get()
+    try:
+        orphan_sink.write(orphans, account_id, region)
+    except Exception:
+        sink_failed()
+
+
+def flush_orphans():
+    try:
+        orphan_sink.flush()
+    except Exception:
+        sink_failed()
+
+
+def sink_failed():
+    sink_errors_metric.inc()
+    print("\nWriting orphans to {} failed:".format(orphan_sink.base_path))
+    traceback.print_exc()
@@ -0,0 +1,106 @@
+import operator
+from config import load_config
+
+
+# Load the config file
+config = load_config()
+
+
+# Rules are declared per resource type under `rules:` in config.yml. Each
+# rule names a metric (a column of the resource records), an operator and
+# either a literal `threshold` or a `threshold_key` naming another config
+# value. A resource is orphaned when any of its rules match, and every
+# matching rule is reported, not just the first. The severity of a rule is
+# low, medium or high; an orphan is as severe as the most severe rule it
+# matched, which the sink and the workbook write next to its reasons and the
+# exporter puts on every reason's series.
+
+# Severities from the least to the most urgent
+severities = ['low', 'medium', 'high']
+
+def is_empty(column, threshold):
+    return column.isna() | (column == '')
+
+operators = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda column, threshold: column.isin(threshold),
+    'not in': lambda column, threshold: ~column.isin(threshold),
+    'empty': is_empty,
+}
+
+
+def load_rules(config):
+    rules = dict()
+    for resource_type, declared in (config.get('rules') or dict()).items():
+        rules[resource_type] = []
+        for rule in declared:
+            if rule['op'] not in operators:
+                raise ValueError("Unknown operator {!r} in rule {}".format(rule['op'], rule['name']))
+            severity = rule.get('severity', 'medium')
+            if severity not in severities:
+                raise ValueError("Unknown severity {!r} in rule {}".format(severity, rule['name']))
+            threshold = config[rule['threshold_key']] if 'threshold_key' in rule else rule.get('threshold')
+            rules[resource_type].append(dict(rule, threshold=threshold, severity=severity))
+    return rules
+
+rules = load_rules(config)
+rule_severities = {
+    (resource_type, rule['name']): rule['severity'] for resource_type, declared in rules.items() for rule in declared
+}
+
+
+def rule_columns(resource_type):
+    # Columns the rules of a resource type read
+    return {rule['metric'] for rule in rules.get(resource_type, [])}
+
+
+def rule_severity(resource_type, name):
+    # None for the reasons of detectors without rules
+    return rule_severities.get((resource_type, name))
+
+
+def orphan_severity(resource_type, reasons):
+    # The most urgent severity of the rules an orphan matched
+    matched = [rule_severity(resource_type, reason) for reason in reasons]
+    matched = [severity for severity in matched if severity]
+    return max(matched, key=severities.index) if matched else None
+
+
+def match_rules(resource_type, records):
+    # records is a list of dicts, one per resource. Every rule is evaluated
+    # column-wise over all of them at once; returns the names of the matching
+    # rules for each record, in the same order as records.
+    if not records:
+        return []
+    # numpy and pandas take longer to import than a short scan takes to
+    # run, so they are only imported once there is something to evaluate;
+    # the sink and the exporter read severities without them
+    import numpy as np
+    import pandas as pd
+
+    # Only the columns some rule reads are built
+    resource_rules = rules.get(resource_type, [])
+    columns = rule_columns(resource_type)
+    frame = pd.DataFrame({
+        column: [record.get(column) for record in records] for column in columns
+    }, index=range(len(records)))
+    matches = np.zeros((len(frame), len(resource_rules)), dtype=bool)
+
+    for index, rule in enumerate(resource_rules):
+        matched = operators[rule['op']](frame[rule['metric']], rule['threshold'])
+        matches[:, index] = matched.fillna(False).to_numpy(dtype=bool)
+
+    # Rows that matched the same rules share one tuple of names: encode each
+    # row's matches as a bitmask and name every distinct mask once
+    masks = matches.astype(np.int64) @ (np.int64(1) << np.arange(len(resource_rules), dtype=np.int64))
+    unique_masks, inverse = np.unique(masks, return_inverse=True)
+    names = [
+        tuple(rule['name'] for index, rule in enumerate(resource_rules) if mask >> index & 1)
+        for mask in unique_masks.tolist()
+    ]
+    return [names[index] for index in inverse.tolist()]
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from config import load_config
+from records import OrphanRecord
+
+
+# Load the config file
+config = load_config()
+
+incremental = config.get('incremental', False)
+state_db = config.get('state_db', 'scan_state.db')
+verdict_ttl_hours = config.get('verdict_ttl_hours', 168)
+
+
+# Incremental scanning keeps a fingerprint of every resource together with
+# the verdict it got. A resource whose fingerprint is unchanged and whose
+# verdict is younger than verdict_ttl_hours is not re-evaluated, so no
+# metrics are fetched for it.
+
+def load_balancer_id(lb):
+    return lb['LoadBalancerArn'].split(':')[-1]
+
+# resource type -> (id of the resource as it appears in detector rows,
+#                   key it is stored under, unique across accounts and regions,
+#                   describe fields that make up its fingerprint)
+resource_types = {
+    'EC2': (lambda instance: instance['InstanceId'], lambda instance: instance['InstanceId'],
+            ['State', 'Tags', 'InstanceType', 'BlockDeviceMappings']),
+    'Volume': (lambda volume: volume['VolumeId'], lambda volume: volume['VolumeId'],
+               ['State', 'Attachments', 'Tags', 'Size', 'VolumeType']),
+    'RDS': (lambda db: db['DBInstanceIdentifier'], lambda db: db['DBInstanceArn'],
+            ['DBInstanceStatus', 'DBInstanceArn', 'TagList', 'DBInstanceClass']),
+    'ELB': (load_balancer_id, lambda lb: lb['LoadBalancerArn'],
+            ['State', 'AvailabilityZones', 'SecurityGroups']),
+}
+
+
+def fingerprint(resource, fields):
+    state = {field: resource.get(field) for field in fields}
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ScanState:
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS verdicts ('
+            'resource_type TEXT, resource_id TEXT, fingerprint TEXT, evaluated_at REAL, row TEXT, '
+            'PRIMARY KEY (resource_type, resource_id))'
+        )
+        self.connection.commit()
+
+    def split_changed(self, resource_type, resources):
+        # Returns the resources that need evaluating, plus the stored orphan
+        # rows of the ones that do not
+        resource_id, resource_key, fields = resource_types[resource_type]
+        fresh_after = time.time() - verdict_ttl_hours * 3600
+
+        with self.lock:
+            stored = dict()
+            ids = [resource_key(resource) for resource in resources]
+            for offset in range(0, len(ids), 500):
+                chunk = ids[offset:offset + 500]
+                cursor = self.connection.execute(
+                    'SELECT resource_id, fingerprint, evaluated_at, row FROM verdicts '
+                    'WHERE resource_type = ? AND resource_id IN ({})'.format(','.join('?' * len(chunk))),
+                    [resource_type] + chunk
+                )
+                stored.update((row[0], row[1:]) for row in cursor)
+
+        changed = []
+        known_orphans = []
+        for resource in resources:
+            previous = stored.get(resource_key(resource))
+            row = json.loads(previous[2]) if previous and previous[2] else None
+            # Orphans stored in the tuple layout of older versions are evaluated again
+            if previous and previous[0] == fingerprint(resource, fields) and previous[1] > fresh_after and (row is None or 'type' in row):
+                if row:
+                    known_orphans.append(OrphanRecord(row['type'], row['id'], tuple(row['values']), tuple(row['reasons'])))
+            else:
+                changed.append(resource)
+
+        return changed, known_orphans
+
+    def record_verdicts(self, resource_type, resources, orphans):
+        resource_id, resource_key, fields = resource_types[resource_type]
+        orphan_rows = {orphan.resource_id: orphan for orphan in orphans}
+        now = time.time()
+
+        records = []
+        for resource in resources:
+            orphan = orphan_rows.get(resource_id(resource))
+            row = None
+            if orphan:
+                row = json.dumps({
+                    'type': orphan.resource_type,
+                    'id': orphan.resource_id,
+                    'values': orphan.values,
+                    'reasons': orphan.reasons,
+                }, default=str)
+            records.append((resource_type, resource_key(resource), fingerprint(resource, fields), now, row))
+
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)', records)
+            self.connection.commit()
+
+
+scan_state = ScanState(state_db) if incremental else None
+
+
+def split_changed(resource_type, resources):
+    if not scan_state:
+        return resources, []
+    return scan_state.split_changed(resource_type, resources)
+
+
+def record_verdicts(resource_type, resources, orphans):
+    if scan_state:
+        scan_state.record_verdicts(resource_type, resources, orphans)
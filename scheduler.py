@@ -0,0 +1,136 @@
+import concurrent.futures
+import json
+import random
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Every detector runs on its own interval, pushed back by a random jitter so
+# detectors and replicas do not all hit the APIs at the same moment. A
+# detector is never run twice at once: a trigger that arrives while it runs
+# makes it run again as soon as the current run finishes.
+
+class Scheduler:
+
+    def __init__(self, detectors, run, schedule, default_interval=86400, default_jitter=0):
+        # run(detectors) scans with the given subset of detectors
+        self.detectors = detectors
+        self.run = run
+        self.intervals = dict()
+        self.jitters = dict()
+        for name in detectors:
+            entry = schedule.get(name) or dict()
+            self.intervals[name] = entry.get('interval', default_interval)
+            self.jitters[name] = entry.get('jitter', default_jitter)
+
+        self.condition = threading.Condition()
+        self.running = set()
+        # Every detector is due straight away, spread by its jitter
+        now = time.monotonic()
+        self.next_run = {name: now + random.uniform(0, self.jitters[name]) for name in detectors}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(detectors))
+
+    def trigger(self, names=None):
+        # Makes the named detectors, or all of them, due now
+        names = list(names or self.detectors)
+        unknown = [name for name in names if name not in self.detectors]
+        if unknown:
+            raise KeyError(', '.join(unknown))
+
+        with self.condition:
+            now = time.monotonic()
+            for name in names:
+                self.next_run[name] = now
+            self.condition.notify()
+        return names
+
+    def status(self):
+        with self.condition:
+            now = time.monotonic()
+            status = dict()
+            for name in self.detectors:
+                next_run = self.next_run[name]
+                status[name] = {
+                    'running': name in self.running,
+                    'next_run_in': None if next_run is None else max(0, round(next_run - now, 1)),
+                }
+            return status
+
+    def _run_detector(self, name):
+        try:
+            self.run({name: self.detectors[name]})
+        except Exception:
+            print("\nScheduled {} scan failed:".format(name))
+            traceback.print_exc()
+        finally:
+            with self.condition:
+                self.running.discard(name)
+                # A trigger during the run has already moved next_run forward
+                if self.next_run[name] is None:
+                    self.next_run[name] = time.monotonic() + self.intervals[name] + random.uniform(0, self.jitters[name])
+                self.condition.notify()
+
+    def run_forever(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                due = [
+                    name for name in self.detectors
+                    if name not in self.running and self.next_run[name] is not None and self.next_run[name] <= now
+                ]
+                for name in due:
+                    self.running.add(name)
+                    # Cleared while running, so a trigger in the meantime is kept
+                    self.next_run[name] = None
+
+                if not due:
+                    pending = [at for name, at in self.next_run.items() if at is not None and name not in self.running]
+                    self.condition.wait(max(0, min(pending) - now) if pending else None)
+                    continue
+
+            for name in due:
+                self.executor.submit(self._run_detector, name)
+
+
+def trigger_handler(scheduler):
+
+    class TriggerHandler(BaseHTTPRequestHandler):
+        # POST /scan runs every detector, POST /scan/<detector> just one,
+        # GET /scan shows what is running and when each detector is next due
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip('/') != '/scan':
+                return self.reply(404, {'error': 'not found'})
+            self.reply(200, scheduler.status())
+
+        def do_POST(self):
+            parts = self.path.strip('/').split('/')
+            if parts[0] != 'scan' or len(parts) > 2:
+                return self.reply(404, {'error': 'not found'})
+            try:
+                names = scheduler.trigger(parts[1:] or None)
+            except KeyError as e:
+                return self.reply(404, {'error': 'unknown detector {}'.format(e.args[0])})
+            self.reply(202, {'triggered': names})
+
+        def log_message(self, format, *args):
+            pass
+
+    return TriggerHandler
+
+
+def start_trigger_server(scheduler, port, addr='127.0.0.1'):
+    server = ThreadingHTTPServer((addr, port), trigger_handler(scheduler))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
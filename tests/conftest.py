@@ -0,0 +1,58 @@
+import os
+import socket
+import sys
+import tempfile
+import pytest
+import yaml
+
+
+# The modules read config.yml once, when they are first imported, so the
+# tests write their own config before anything imports them: the repository
+# config with every output in a temporary directory and every client pointed
+# at a moto server on a free local port.
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+output_dir = tempfile.mkdtemp(prefix='orphan-tests-')
+
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+moto_port = free_port()
+endpoint_url = 'http://127.0.0.1:{}'.format(moto_port)
+
+with open(os.path.join(repository, 'config.yml')) as config_file:
+    test_config = yaml.safe_load(config_file)
+test_config.update(
+    profiles=None,
+    regions=None,
+    region_name='us-east-1',
+    endpoint_url=endpoint_url,
+    sink_path=os.path.join(output_dir, 'orphaned'),
+    excel_report=None,
+    incremental=False,
+    metric_cache=False,
+    metric_history=False,
+    profiling=False,
+)
+config_path = os.path.join(output_dir, 'config.yml')
+with open(config_path, 'w') as config_file:
+    yaml.safe_dump(test_config, config_file)
+
+os.environ['ORPHANS_CONFIG'] = config_path
+os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing', AWS_DEFAULT_REGION='us-east-1')
+os.environ.pop('AWS_PROFILE', None)
+
+
+@pytest.fixture(scope='session')
+def moto_server():
+    server_module = pytest.importorskip('moto.server')
+    server = server_module.ThreadedMotoServer(ip_address='127.0.0.1', port=moto_port, verbose=False)
+    server.start()
+    yield endpoint_url
+    server.stop()
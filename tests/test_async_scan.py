@@ -0,0 +1,141 @@
+import boto3
+import pytest
+from fanout import Target, scan_target
+from identify_orphaned_resources import load_detectors
+
+
+def seed_estate(endpoint_url):
+    # Three instances, five volumes, an unassociated address and a database,
+    # all idle since the moto server has no datapoints for them
+    ec2 = boto3.client('ec2', region_name='us-east-1', endpoint_url=endpoint_url)
+    image_id = ec2.describe_images()['Images'][0]['ImageId']
+    ec2.run_instances(ImageId=image_id, MinCount=3, MaxCount=3)
+    for index in range(5):
+        tags = [{'ResourceType': 'volume', 'Tags': [{'Key': 'Name', 'Value': 'volume-{}'.format(index)}]}] if index % 2 else []
+        ec2.create_volume(Size=1, AvailabilityZone='us-east-1a', TagSpecifications=tags)
+    ec2.allocate_address(Domain='vpc')
+
+    rds = boto3.client('rds', region_name='us-east-1', endpoint_url=endpoint_url)
+    rds.create_db_instance(
+        DBInstanceIdentifier='orphan-db', DBInstanceClass='db.t3.micro', Engine='postgres',
+        MasterUsername='admin', MasterUserPassword='password123', AllocatedStorage=20
+    )
+
+
+def verdicts(target_result):
+    assert target_result.error is None
+    return {
+        name: sorted((orphan.resource_type, orphan.resource_id, orphan.reasons) for orphan in phase.result)
+        for name, phase in target_result.phases.items()
+    }
+
+
+def test_async_engine_matches_threads_engine(moto_server):
+    pytest.importorskip('aiobotocore')
+    seed_estate(moto_server)
+    detectors = load_detectors()
+    target = Target(None, 'us-east-1')
+
+    threads_result = scan_target(target, detectors, engine='threads')
+    async_result = scan_target(target, detectors, engine='async', endpoint_url=moto_server)
+
+    assert async_result.account_id == threads_result.account_id
+    threads_verdicts = verdicts(threads_result)
+    assert verdicts(async_result) == threads_verdicts
+    assert len(threads_verdicts['EC2']) == 3
+    assert len(threads_verdicts['Volume']) == 5
+    assert len(threads_verdicts['EIP']) == 1
+    assert len(threads_verdicts['RDS']) == 1
+
+
+class FakeCloudWatch:
+    # Answers every query with one datapoint and records the windows asked for
+
+    def __init__(self):
+        self.windows = []
+
+    async def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **kwargs):
+        self.windows.append((StartTime, EndTime))
+        return {'MetricDataResults': [{'Id': query['Id'], 'Values': [1.0]} for query in MetricDataQueries]}
+
+
+def test_async_engine_caches_the_scan_window(tmp_path, monkeypatch):
+    pytest.importorskip('aiobotocore')
+    import asyncio
+    import datetime
+    import async_scan
+    from metric_cache import MetricCache
+    from metric_data import metric_stat
+    from query_planner import aggregate_queries, scan_window
+
+    cache = MetricCache(str(tmp_path / 'cache.db'), 100)
+    monkeypatch.setattr(async_scan, 'metric_cache', cache)
+    # Half past an hour, so a window aligned to the query's daily period would end at midnight
+    now = datetime.datetime.utcnow().replace(minute=30, second=0, microsecond=0)
+    start_time, end_time = scan_window(hours=24, align=3600, now=now)
+    queries = aggregate_queries({'i-1': metric_stat('AWS/EC2', 'CPUUtilization', 'InstanceId', 'i-1', 'Average', 86400)},
+                                start_time, end_time, 'window')
+    cloudwatch = FakeCloudWatch()
+
+    async def fetch_twice():
+        semaphore = asyncio.Semaphore(4)
+        first = await async_scan.get_metric_data_async(cloudwatch, queries, start_time, end_time, semaphore)
+        second = await async_scan.get_metric_data_async(cloudwatch, queries, start_time, end_time, semaphore)
+        return first, second
+
+    first, second = asyncio.run(fetch_twice())
+    # The window ends on the hour the planner uses, not the previous midnight
+    assert cloudwatch.windows == [(now - datetime.timedelta(hours=24, minutes=30), now.replace(minute=0))]
+    assert first == second == {'i-1': [1.0]}
+    expires_at, = cache.connection.execute('SELECT expires_at FROM series').fetchone()
+    assert expires_at == end_time.replace(tzinfo=datetime.timezone.utc).timestamp() + 3600
+
+
+def test_async_page_cache_describes_each_page_once():
+    pytest.importorskip('aiobotocore')
+    import asyncio
+    from async_scan import AsyncPageCache
+
+    described = []
+
+    async def source():
+        for index in range(3):
+            described.append(index)
+            await asyncio.sleep(0)
+            yield [index]
+
+    async def consume(cache, seen):
+        async for page in cache:
+            # Each page reaches the consumer before the next one is described
+            seen.append((page, list(described)))
+
+    async def run():
+        cache = AsyncPageCache(source())
+        first, second = [], []
+        await asyncio.gather(consume(cache, first), consume(cache, second))
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert described == [0, 1, 2]
+    assert [page for page, before in first] == [page for page, before in second] == [[0], [1], [2]]
+    assert first[0][1] == [0]
+
+
+def test_async_page_cache_fails_every_consumer():
+    pytest.importorskip('aiobotocore')
+    import asyncio
+    from async_scan import AsyncPageCache
+
+    async def source():
+        yield [0]
+        raise RuntimeError('throttled')
+
+    async def consume(cache):
+        return [page async for page in cache]
+
+    async def run():
+        cache = AsyncPageCache(source())
+        return await asyncio.gather(consume(cache), consume(cache), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert [str(result) for result in results] == ['throttled', 'throttled']
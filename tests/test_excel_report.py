@@ -0,0 +1,31 @@
+import os
+from config import load_config
+from fanout import Target, TargetResult
+from identify_orphaned_resources import ScanRunner
+from orchestrator import PhaseResult
+from records import orphan_record
+
+
+def eip_result(allocation_id):
+    phases = {'EIP': PhaseResult('EIP', {orphan_record('EIP', allocation_id, {})}, None, 1.0)}
+    return TargetResult(Target(None, 'us-east-1'), '111111111111', phases, None)
+
+
+def test_workbook_is_rewritten_at_most_once_per_interval(tmp_path):
+    runner = ScanRunner(load_config())
+    runner.excel_report = str(tmp_path / 'orphaned_resources.xlsx')
+    runner.excel_report_interval = 3600
+
+    runner.write_report_workbook([eip_result('eipalloc-1')])
+    written = os.path.getmtime(runner.excel_report)
+    os.utime(runner.excel_report, (0, 0))
+
+    # A run within the interval is held back until the next write
+    runner.write_report_workbook([eip_result('eipalloc-2')])
+    assert os.path.getmtime(runner.excel_report) == 0
+    assert runner.report_pending
+
+    runner.report_written_at -= 3600
+    runner.write_report_workbook([])
+    assert os.path.getmtime(runner.excel_report) >= written
+    assert not runner.report_pending
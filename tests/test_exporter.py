@@ -0,0 +1,38 @@
+from exporter import OrphanCollector
+from fanout import Target, TargetResult
+from orchestrator import PhaseResult
+from records import orphan_record
+from result_sink import columns, orphan_row
+
+
+def rds_result(account_id):
+    orphan = orphan_record('RDS', 'shared-name', {'DBConnections': 0}, ('no_connections',))
+    phases = {'RDS': PhaseResult('RDS', {orphan}, None, 1.0)}
+    return TargetResult(Target(None, 'us-east-1'), account_id, phases, None)
+
+
+def test_same_resource_in_two_accounts_gets_two_series():
+    collector = OrphanCollector()
+    collector.publish([rds_result('111111111111'), rds_result('222222222222')])
+    families = {family.name: family for family in collector.collect()}
+
+    orphaned = families['orphaned_resource'].samples
+    assert sorted(sample.labels['account_id'] for sample in orphaned) == ['111111111111', '222222222222']
+    metric_labels = [tuple(sorted(sample.labels.items())) for sample in families['orphaned_resource_metric'].samples]
+    assert len(metric_labels) == len(set(metric_labels)) == 2
+    assert families['orphaned_resources'].samples[0].value == 2
+
+
+def test_orphans_carry_the_severity_of_their_rules():
+    orphan = orphan_record('RDS', 'db-1', {}, ('missing_required_tags', 'unusable_status'))
+    resource_type, row = orphan_row(orphan, '111111111111', 'us-east-1')
+    assert dict(zip(columns(resource_type), row))['severity'] == 'high'
+
+    collector = OrphanCollector()
+    collector.publish([rds_result('111111111111')])
+    families = {family.name: family for family in collector.collect()}
+    assert [sample.labels['severity'] for sample in families['orphaned_resource'].samples] == ['medium']
+
+    # Checks that are not rules have no severity
+    resource_type, row = orphan_row(orphan_record('VOLUME', 'vol-1', {}, ('unattached',)))
+    assert row[-1] is None
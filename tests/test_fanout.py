@@ -0,0 +1,32 @@
+from fanout import Target, get_targets, scan_target
+from identify_orphaned_resources import load_detectors
+
+
+def test_default_profile_uses_the_default_credential_chain():
+    targets = get_targets({'region_name': 'us-east-1', 'profiles': ['default', 'prod'], 'regions': None})
+    assert targets == [Target(None, 'us-east-1'), Target('prod', 'us-east-1')]
+
+
+def test_named_profile_is_scanned_with_its_own_credentials(moto_server, tmp_path, monkeypatch):
+    config_file = tmp_path / 'config'
+    config_file.write_text('[profile named]\nregion = us-east-1\n')
+    credentials_file = tmp_path / 'credentials'
+    credentials_file.write_text('[named]\naws_access_key_id = named\naws_secret_access_key = named\n')
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(config_file))
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(credentials_file))
+
+    result = scan_target(Target('named', 'us-east-1'), load_detectors(['EIP']))
+    assert result.error is None
+    assert result.account_id
+    assert 'EIP' in result.phases
+
+
+def test_default_profile_needs_no_aws_config(moto_server, tmp_path, monkeypatch):
+    # Environment credentials only, as on Lambda or with an instance role
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'missing'))
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'missing'))
+
+    target, = get_targets({'region_name': 'us-east-1', 'profiles': ['default']})
+    result = scan_target(target, load_detectors(['EIP']))
+    assert result.error is None
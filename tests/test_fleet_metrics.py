@@ -0,0 +1,127 @@
+import datetime
+import threading
+import time
+from botocore.exceptions import ClientError
+from fleet_metrics import FleetMetrics
+from metric_data import metric_stat
+
+
+start_time, end_time = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 1, 2)
+
+
+class FakeInsights:
+    # Answers Metrics Insights queries with one series per instance, labelled
+    # with its id, split over two pages; error makes every request fail and
+    # hold makes the first request wait for release
+
+    def __init__(self, instance_values, error=False, hold=False):
+        self.instance_values = instance_values
+        self.error = error
+        self.hold = hold
+        self.requests = []
+        self.sending = threading.Event()
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    def get_metric_data(self, **kwargs):
+        with self.lock:
+            self.requests.append(kwargs)
+        if self.hold:
+            self.sending.set()
+            self.release.wait(5)
+        if self.error:
+            raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'no Insights'}}, 'GetMetricData')
+
+        # The first page holds the first instance, the second page the rest
+        instances = list(self.instance_values.items())
+        page = instances[1:] if kwargs.get('NextToken') else instances[:1]
+        response = {'MetricDataResults': [
+            {'Id': query['Id'], 'Label': instance_id, 'Values': values}
+            for query in kwargs['MetricDataQueries'] for instance_id, values in page
+        ]}
+        if not kwargs.get('NextToken'):
+            response['NextToken'] = 'page-2'
+        return response
+
+
+def cpu_queries(instance_ids):
+    return {
+        instance_id: metric_stat('AWS/EC2', 'CPUUtilization', 'InstanceId', instance_id, 'Average', 3600)
+        for instance_id in instance_ids
+    }
+
+
+def test_result_under_the_limit_answers_missing_resources_as_empty():
+    cloudwatch = FakeInsights({'i-1': [1.0], 'i-2': [2.0, 3.0]})
+    fleet = FleetMetrics(cloudwatch, start_time, end_time, limit=5)
+
+    answered, remaining = fleet.split(cpu_queries(['i-1', 'i-2', 'i-3']))
+    # Series are joined by their label across both pages
+    assert answered == {'i-1': [1.0], 'i-2': [2.0, 3.0], 'i-3': []}
+    assert remaining == {}
+    expression = cloudwatch.requests[0]['MetricDataQueries'][0]['Expression']
+    assert expression == 'SELECT AVG(CPUUtilization) FROM SCHEMA("AWS/EC2", InstanceId) GROUP BY InstanceId LIMIT 5'
+
+    # The fleet is fetched once per scan
+    fleet.split(cpu_queries(['i-4']))
+    assert len(cloudwatch.requests) == 2
+
+
+def test_result_at_the_limit_leaves_missing_resources_to_single_queries():
+    cloudwatch = FakeInsights({'i-1': [1.0], 'i-2': [2.0]})
+    fleet = FleetMetrics(cloudwatch, start_time, end_time, limit=2)
+
+    queries = cpu_queries(['i-1', 'i-2', 'i-3'])
+    answered, remaining = fleet.split(queries)
+    assert answered == {'i-1': [1.0], 'i-2': [2.0]}
+    assert remaining == {'i-3': queries['i-3']}
+
+
+def test_failed_fleet_query_leaves_every_query_to_single_queries():
+    cloudwatch = FakeInsights({'i-1': [1.0]}, error=True)
+    fleet = FleetMetrics(cloudwatch, start_time, end_time, limit=5)
+
+    queries = cpu_queries(['i-1', 'i-2'])
+    answered, remaining = fleet.split(queries)
+    assert answered == {}
+    assert remaining == queries
+
+    # A failed fleet is not asked for again
+    fleet.split(queries)
+    assert len(cloudwatch.requests) == 1
+
+
+def test_queries_no_fleet_query_answers_are_left_alone():
+    cloudwatch = FakeInsights({'i-1': [1.0]})
+    fleet = FleetMetrics(cloudwatch, start_time, end_time, limit=5)
+
+    queries = {'p99': metric_stat('AWS/EC2', 'CPUUtilization', 'InstanceId', 'i-1', 'p99', 3600)}
+    assert fleet.split(queries) == ({}, queries)
+    assert cloudwatch.requests == []
+
+
+def test_callers_wait_for_a_fleet_being_fetched():
+    cloudwatch = FakeInsights({'i-1': [1.0], 'i-2': [2.0]}, hold=True)
+    fleet = FleetMetrics(cloudwatch, start_time, end_time, limit=5)
+    results = dict()
+
+    def split(name, instance_ids):
+        results[name] = fleet.split(cpu_queries(instance_ids))
+
+    first = threading.Thread(target=split, args=('first', ['i-1']))
+    first.start()
+    assert cloudwatch.sending.wait(5)
+    second = threading.Thread(target=split, args=('second', ['i-2']))
+    second.start()
+
+    # The second caller waits for the fetch in flight instead of sending its own
+    time.sleep(0.1)
+    assert second.is_alive()
+    cloudwatch.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert results['first'] == ({'i-1': [1.0]}, {})
+    assert results['second'] == ({'i-2': [2.0]}, {})
+    # One request and its second page
+    assert len(cloudwatch.requests) == 2
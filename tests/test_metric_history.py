@@ -0,0 +1,119 @@
+import math
+import os
+import numpy as np
+import pytest
+import metric_history
+from metric_history import HistoryColumns, history_column
+
+
+day = 86400
+now = 1700000000
+
+
+def history(path, appended_at=()):
+    # HistoryColumns over two metrics, with a scan appended at each of the
+    # given days before now: i-1 reads the day, i-2 ten more and i-3 nothing
+    columns = HistoryColumns(str(path), ['CPU_Util', 'DiskReadOps'])
+    for days_ago in appended_at:
+        scan_metrics = {
+            'i-1': {'CPU_Util': float(days_ago), 'DiskReadOps': 0},
+            'i-2': {'CPU_Util': 10.0 + days_ago, 'DiskReadOps': None},
+            'i-3': {'CPU_Util': None},
+        }
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr(metric_history.time, 'time', lambda: now - days_ago * day)
+            columns.append(scan_metrics)
+    return columns
+
+
+def rolling(columns, metric, days, statistic, ids=('i-1', 'i-2', 'i-3', 'i-9')):
+    return columns.rolling(metric, list(ids), days, statistic, now=now).tolist()
+
+
+def same(values, expected):
+    return len(values) == len(expected) and all(math.isnan(a) if math.isnan(b) else a == b for a, b in zip(values, expected))
+
+
+def test_rolling_windows(tmp_path):
+    columns = history(tmp_path, appended_at=[5, 3, 1])
+    nan = float('nan')
+
+    assert same(rolling(columns, 'CPU_Util', 4, 'max'), [3, 13, nan, nan])
+    assert same(rolling(columns, 'CPU_Util', 6, 'min'), [1, 11, nan, nan])
+    assert same(rolling(columns, 'CPU_Util', 6, 'mean'), [3, 13, nan, nan])
+    assert same(rolling(columns, 'CPU_Util', 2, 'sum'), [1, 11, nan, nan])
+    assert same(rolling(columns, 'DiskReadOps', 6, 'count'), [3, 0, 0, nan])
+    assert same(rolling(columns, 'Unknown', 6, 'max'), [nan, nan, nan, nan])
+
+
+def test_append_writes_only_the_new_rows(tmp_path):
+    columns = history(tmp_path, appended_at=[2])
+    sizes = {name: os.path.getsize(columns.file(name)) for name, dtype in columns.files()}
+    history_again = history(tmp_path, appended_at=[1])
+
+    for name, dtype in history_again.files():
+        assert os.path.getsize(columns.file(name)) == sizes[name] + 3 * dtype.itemsize
+    with open(os.path.join(str(tmp_path), 'resources.txt')) as index_file:
+        assert index_file.read().split() == ['i-1', 'i-2', 'i-3']
+
+
+def test_expiry_drops_rows_past_the_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(metric_history, 'metric_history_retention_days', 3)
+    columns = history(tmp_path, appended_at=[10, 9, 2, 0])
+
+    assert columns.rows == 6
+    assert same(rolling(columns, 'CPU_Util', 30, 'max'), [2, 12, float('nan'), float('nan')])
+    assert HistoryColumns(str(tmp_path), columns.columns).rows == 6
+    assert not os.path.exists(columns.marker())
+
+
+def test_crash_during_expiry_before_the_marker_keeps_the_old_columns(tmp_path):
+    columns = history(tmp_path, appended_at=[2, 1])
+    # Only some columns had their .tmp written when the process died
+    np.zeros(1, metric_history.time_dtype).tofile(columns.file('time') + '.tmp')
+
+    reopened = HistoryColumns(str(tmp_path), columns.columns)
+    assert reopened.rows == 6
+    assert not os.path.exists(columns.file('time') + '.tmp')
+    assert same(rolling(reopened, 'CPU_Util', 3, 'max'), [2, 12, float('nan'), float('nan')])
+
+
+def test_crash_during_expiry_after_the_marker_swaps_every_column(tmp_path):
+    columns = history(tmp_path, appended_at=[5, 1])
+    # Every .tmp holds the last scan only and the first column was swapped in
+    for name, dtype in columns.files():
+        np.array(columns.column(name, dtype, columns.rows)[3:]).tofile(columns.file(name) + '.tmp')
+    open(columns.marker(), 'w').close()
+    os.replace(columns.file('time') + '.tmp', columns.file('time'))
+
+    reopened = HistoryColumns(str(tmp_path), columns.columns)
+    assert reopened.rows == 3
+    assert not os.path.exists(reopened.marker())
+    assert same(rolling(reopened, 'CPU_Util', 30, 'min'), [1, 11, float('nan'), float('nan')])
+
+
+def test_crash_during_append_truncates_to_the_shortest_column(tmp_path):
+    columns = history(tmp_path, appended_at=[1])
+    with open(columns.file('time'), 'ab') as column_file:
+        column_file.write(np.zeros(2, metric_history.time_dtype).tobytes())
+
+    reopened = HistoryColumns(str(tmp_path), columns.columns)
+    assert reopened.rows == 3
+    assert os.path.getsize(columns.file('time')) == 3 * metric_history.time_dtype.itemsize
+
+
+def test_history_column_names():
+    match = history_column.match('CPU_Util_max_30d')
+    assert (match['metric'], match['statistic'], match['days']) == ('CPU_Util', 'max', '30')
+    assert history_column.match('CPU_Util') is None
+
+
+def test_new_metric_column_is_padded_instead_of_truncating(tmp_path):
+    columns = history(tmp_path, appended_at=[2, 1])
+    os.remove(columns.file('DiskReadOps'))
+
+    reopened = HistoryColumns(str(tmp_path), ['CPU_Util', 'DiskReadOps'])
+    assert reopened.rows == 6
+    assert os.path.getsize(columns.file('CPU_Util')) == 6 * metric_history.value_dtype.itemsize
+    assert same(rolling(reopened, 'CPU_Util', 3, 'max'), [2, 12, float('nan'), float('nan')])
+    assert same(rolling(reopened, 'DiskReadOps', 3, 'count'), [0, 0, 0, float('nan')])
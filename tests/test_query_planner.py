@@ -0,0 +1,166 @@
+import datetime
+import importlib
+import threading
+import time
+import pytest
+import fleet_metrics
+from config import load_config
+from instrumentation import current_detector, detector_context
+from metric_data import metric_stat
+from query_planner import MetricPlanner
+
+
+window = (datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 2))
+
+
+class FakeCloudWatch:
+    # Answers every query with a single datapoint and records each request;
+    # fail_first makes the first request wait for release and then fail
+
+    def __init__(self, fail_first=False):
+        self.requests = []
+        self.detectors = []
+        self.lock = threading.Lock()
+        self.fail_first = fail_first
+        self.sending = threading.Event()
+        self.release = threading.Event()
+
+    def get_metric_data(self, **kwargs):
+        with self.lock:
+            self.requests.append(kwargs['MetricDataQueries'])
+            self.detectors.append(current_detector.get())
+            first = len(self.requests) == 1
+        if first and self.fail_first:
+            self.sending.set()
+            self.release.wait(5)
+            raise RuntimeError('GetMetricData failed')
+        return {'MetricDataResults': [
+            {'Id': query['Id'], 'Values': [1.0]} for query in kwargs['MetricDataQueries']
+        ]}
+
+    def series_sent(self):
+        return [query['MetricStat']['Metric']['Dimensions'][0]['Value'] for request in self.requests for query in request]
+
+
+def cpu_queries(instance_ids):
+    return {
+        instance_id: metric_stat('AWS/EC2', 'CPUUtilization', 'InstanceId', instance_id, 'Average', 3600)
+        for instance_id in instance_ids
+    }
+
+
+def test_concurrent_callers_share_series():
+    cloudwatch = FakeCloudWatch()
+    planner = MetricPlanner(cloudwatch, window=window, linger=0.3, aggregation='series')
+    results = dict()
+
+    def get(name, instance_ids):
+        results[name] = planner.get(cpu_queries(instance_ids))
+
+    callers = [
+        threading.Thread(target=get, args=('first', ['i-1', 'i-2', 'i-3'])),
+        threading.Thread(target=get, args=('second', ['i-2', 'i-3', 'i-4'])),
+    ]
+    for caller in callers:
+        caller.start()
+        time.sleep(0.05)
+    for caller in callers:
+        caller.join(5)
+
+    # Both callers' series went out once, in a single request
+    assert sorted(cloudwatch.series_sent()) == ['i-1', 'i-2', 'i-3', 'i-4']
+    assert len(cloudwatch.requests) == 1
+    assert results['first'] == {'i-1': [1.0], 'i-2': [1.0], 'i-3': [1.0]}
+    assert results['second'] == {'i-2': [1.0], 'i-3': [1.0], 'i-4': [1.0]}
+    # Nothing is kept once every caller has its values
+    assert not planner.series and not planner.waiting and not planner.pending
+
+
+def test_failed_request_is_requeued_for_waiting_callers():
+    cloudwatch = FakeCloudWatch(fail_first=True)
+    planner = MetricPlanner(cloudwatch, window=window, linger=0.05, aggregation='series')
+    outcomes = dict()
+
+    def get(name):
+        try:
+            outcomes[name] = planner.get(cpu_queries(['i-1']))
+        except RuntimeError as error:
+            outcomes[name] = error
+
+    sender = threading.Thread(target=get, args=('sender',))
+    sender.start()
+    assert cloudwatch.sending.wait(5)
+
+    # The second caller waits for the series the first one is sending
+    waiter = threading.Thread(target=get, args=('waiter',))
+    waiter.start()
+    time.sleep(0.1)
+    cloudwatch.release.set()
+    sender.join(5)
+    waiter.join(5)
+
+    assert isinstance(outcomes['sender'], RuntimeError)
+    assert outcomes['waiter'] == {'i-1': [1.0]}
+    assert cloudwatch.series_sent() == ['i-1', 'i-1']
+
+
+def test_part_filled_request_is_sent_after_linger():
+    cloudwatch = FakeCloudWatch()
+    planner = MetricPlanner(cloudwatch, window=window, linger=0.2, aggregation='series')
+
+    start = time.monotonic()
+    assert planner.get(cpu_queries(['i-1', 'i-2'])) == {'i-1': [1.0], 'i-2': [1.0]}
+    elapsed = time.monotonic() - start
+
+    assert 0.2 <= elapsed < 2
+    assert len(cloudwatch.requests) == 1
+
+
+def test_full_request_is_sent_without_lingering():
+    cloudwatch = FakeCloudWatch()
+    planner = MetricPlanner(cloudwatch, window=window, linger=30, aggregation='series')
+
+    start = time.monotonic()
+    results = planner.get(cpu_queries(['i-{}'.format(index) for index in range(500)]))
+
+    assert time.monotonic() - start < 5
+    assert len(results) == 500
+    assert len(cloudwatch.requests) == 1
+
+
+def test_shared_requests_are_accounted_to_the_planner():
+    cloudwatch = FakeCloudWatch()
+    planner = MetricPlanner(cloudwatch, window=window, linger=0, aggregation='series')
+    with detector_context('EC2'):
+        planner.get(cpu_queries(['i-1']))
+
+    assert cloudwatch.detectors == ['planner']
+
+
+def test_window_aggregation_asks_for_one_period():
+    cloudwatch = FakeCloudWatch()
+    planner = MetricPlanner(cloudwatch, window=window, linger=0, aggregation='window')
+    planner.get(cpu_queries(['i-1']))
+
+    assert cloudwatch.requests[0][0]['MetricStat']['Period'] == 86400
+
+
+def test_unknown_aggregation_is_rejected():
+    planner = MetricPlanner(FakeCloudWatch(), window=window, linger=0, aggregation='hourly')
+    with pytest.raises(ValueError):
+        planner.get(cpu_queries(['i-1']))
+
+
+def test_fleet_queries_with_a_longer_window_are_rejected(monkeypatch):
+    config = load_config()
+    monkeypatch.setitem(config, 'metric_fleet_queries', True)
+    monkeypatch.setitem(config, 'metric_window_hours', 24)
+    try:
+        with pytest.raises(ValueError, match='metric_window_hours'):
+            importlib.reload(fleet_metrics)
+
+        monkeypatch.setitem(config, 'metric_window_hours', 2)
+        assert importlib.reload(fleet_metrics).metric_fleet_queries
+    finally:
+        monkeypatch.undo()
+        importlib.reload(fleet_metrics)
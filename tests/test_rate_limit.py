@@ -0,0 +1,95 @@
+import asyncio
+import time
+import pytest
+import rate_limit
+from rate_limit import TokenBucket, get_bucket
+
+
+def test_success_raises_the_rate_additively():
+    bucket = TokenBucket(10, ('test', 'us-east-1', 'Success'))
+    bucket.on_success()
+    assert bucket.rate == 10 + rate_limit.rate_limit_increase / 10
+
+
+def test_throttle_cuts_the_rate_down_to_the_minimum():
+    bucket = TokenBucket(4, ('test', 'us-east-1', 'Throttle'))
+    bucket.on_throttle()
+    assert bucket.rate == 4 * rate_limit.rate_limit_decrease
+    assert bucket.tokens <= 0
+
+    for attempt in range(20):
+        bucket.on_throttle()
+    assert bucket.rate == rate_limit.rate_limit_min
+
+
+def test_rate_never_exceeds_the_maximum():
+    bucket = TokenBucket(rate_limit.rate_limit_max, ('test', 'us-east-1', 'Maximum'))
+    bucket.on_success()
+    assert bucket.rate == rate_limit.rate_limit_max
+
+
+def test_acquire_waits_once_the_burst_is_spent():
+    bucket = TokenBucket(20, ('test', 'us-east-1', 'Acquire'))
+    start = time.monotonic()
+    for attempt in range(20):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.2
+
+    # The next ten tokens take about half a second at 20 per second
+    for attempt in range(10):
+        bucket.acquire()
+    assert 0.4 <= time.monotonic() - start < 2
+
+
+def test_every_attempt_of_a_client_takes_a_token(moto_server):
+    from clients import get_client
+    # A region of its own, so the bucket starts fresh
+    ec2 = get_client('ec2', region='eu-west-3')
+    ec2.describe_volumes()
+
+    initial_rate = rate_limit.rate_limits.get('DescribeVolumes', rate_limit.rate_limit_default)
+    bucket = get_bucket(None, 'eu-west-3', 'DescribeVolumes')
+    assert bucket.tokens <= initial_rate - 1
+    # The successful response raised the rate
+    assert bucket.rate > initial_rate
+
+
+def test_async_acquire_waits_without_blocking_the_loop():
+    bucket = TokenBucket(20, ('test', 'us-east-1', 'AcquireAsync'))
+    ticks = []
+
+    async def ticker():
+        while len(ticks) < 5:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def run():
+        start = time.monotonic()
+        ticking = asyncio.create_task(ticker())
+        for attempt in range(30):
+            await bucket.acquire_async()
+        end = time.monotonic()
+        await ticking
+        return start, end
+
+    start, end = asyncio.run(run())
+    assert end - start >= 0.4
+    # The ticker kept running while the acquires waited
+    assert ticks[-1] < end
+
+
+def test_async_client_attempts_share_the_buckets(moto_server):
+    pytest.importorskip('aiobotocore')
+    from aiobotocore.session import AioSession
+
+    async def describe():
+        session = AioSession()
+        async with session.create_client('ec2', region_name='eu-central-1', endpoint_url=moto_server) as ec2:
+            rate_limit.register_rate_limiter(ec2, None, 'eu-central-1', asynchronous=True)
+            await ec2.describe_volumes()
+
+    asyncio.run(describe())
+    initial_rate = rate_limit.rate_limits.get('DescribeVolumes', rate_limit.rate_limit_default)
+    bucket = get_bucket(None, 'eu-central-1', 'DescribeVolumes')
+    assert bucket.tokens <= initial_rate - 1
+    assert bucket.rate > initial_rate
@@ -0,0 +1,25 @@
+import importlib.util
+import pytest
+import result_sink
+from records import orphan_record
+from result_sink import ResultSink
+
+
+def test_parquet_without_pyarrow_fails_at_startup(tmp_path):
+    if importlib.util.find_spec('pyarrow'):
+        pytest.skip('pyarrow is installed')
+    with pytest.raises(ValueError, match='pyarrow'):
+        ResultSink(str(tmp_path / 'orphaned'), 'parquet')
+
+
+def test_failed_writes_do_not_fail_the_scan(tmp_path, monkeypatch):
+    # The sink's directory is a file, so every flush fails
+    blocker = tmp_path / 'blocker'
+    blocker.write_text('')
+    sink = ResultSink(str(blocker / 'orphaned'), 'csv', buffer_rows=1)
+    monkeypatch.setattr(result_sink, 'orphan_sink', sink)
+    errors = result_sink.sink_errors_metric._value.get()
+
+    result_sink.write_orphans([orphan_record('EIP', 'eipalloc-1', {})])
+    result_sink.flush_orphans()
+    assert result_sink.sink_errors_metric._value.get() == errors + 1
@@ -0,0 +1,117 @@
+import itertools
+import os
+import subprocess
+import sys
+import pytest
+from config import load_config
+from rules import match_rules
+
+
+config = load_config()
+
+
+# The checks of the elif ladders the EC2 and RDS detectors ran before the
+# rule engine, in their order, as (rule name, field, check). A resource was
+# orphaned when any of them matched.
+ec2_ladder = [
+    ('instance_failed', 'State', lambda value: value == 'failed'),
+    ('no_disk_read_ops', 'DiskReadOps', lambda value: value == config['diskReadOps']),
+    ('no_disk_write_ops', 'DiskWriteOps', lambda value: value == config['diskWriteOps']),
+    ('low_cpu', 'CPU_Util', lambda value: value < config['cpu_utilisation_threshold']),
+    ('no_disk_read_bytes', 'DiskReadBytes', lambda value: value == config['diskReadBytes']),
+    ('no_disk_write_bytes', 'DiskWriteBytes', lambda value: value == config['diskWriteBytes']),
+    ('status_check_failed', 'StatusCheckFailed', lambda value: value >= config['min_statusCheckFailed']),
+]
+
+rds_ladder = [
+    ('unusable_status', 'Status', lambda value: value not in ['available', 'stopped']),
+    ('missing_identifier', 'db_identifier', lambda value: not value),
+    ('missing_arn', 'ARN', lambda value: not value),
+    ('older_than_threshold', 'age_days', lambda value: value > config['threshold_days']),
+    ('missing_required_tags', 'missing_tags', lambda value: value > 0),
+    ('no_connections', 'DBConnections', lambda value: value == config['dbconnections_threshold']),
+    ('low_read_latency', 'ReadLatency', lambda value: value < config['readLatency_threshold']),
+    ('low_write_latency', 'WriteLatency', lambda value: value < config['writeLatency_threshold']),
+    ('low_freeable_memory', 'FreeableMem', lambda value: value < config['freeableMem_threshold']),
+    ('low_free_storage', 'FreeStorageSpace', lambda value: value < config['freeStorage_threhsold']),
+    ('no_cpu_surplus', 'cpuSurplus', lambda value: value == config['cpuSurplus_threshold']),
+    ('burst_balance_full', 'BurstBalance', lambda value: value <= config['burstBalance_threshold']),
+    ('ebs_io_balance_full', 'ebsIOBalance', lambda value: value <= config['ebsIOBalance_threshold']),
+    ('ebs_byte_balance_full', 'ebsByteBalance', lambda value: value <= config['ebsByteBalance_threshold']),
+]
+
+# Records matching no check
+ec2_busy = dict(State='running', DiskReadOps=5, DiskWriteOps=5, CPU_Util=50, DiskReadBytes=5, DiskWriteBytes=5,
+                StatusCheckFailed=0)
+rds_busy = dict(Status='available', db_identifier='db-1', ARN='arn:aws:rds:us-east-1:123456789012:db:db-1',
+                age_days=1, missing_tags=0, DBConnections=5, ReadLatency=1, WriteLatency=1, FreeableMem=1e12,
+                FreeStorageSpace=1e12, cpuSurplus=5, BurstBalance=101, ebsIOBalance=101, ebsByteBalance=101)
+
+# Values tried for the fields that are not compared with a config threshold
+field_values = {
+    'State': ['running', 'stopped', 'failed'],
+    'Status': ['available', 'stopped', 'deleting'],
+    'db_identifier': ['db-1', '', None],
+    'ARN': ['arn:aws:rds:us-east-1:123456789012:db:db-1', '', None],
+    'missing_tags': [0, 1, 2],
+}
+
+threshold_keys = {
+    'DiskReadOps': 'diskReadOps', 'DiskWriteOps': 'diskWriteOps', 'CPU_Util': 'cpu_utilisation_threshold',
+    'DiskReadBytes': 'diskReadBytes', 'DiskWriteBytes': 'diskWriteBytes', 'StatusCheckFailed': 'min_statusCheckFailed',
+    'age_days': 'threshold_days', 'DBConnections': 'dbconnections_threshold', 'ReadLatency': 'readLatency_threshold',
+    'WriteLatency': 'writeLatency_threshold', 'FreeableMem': 'freeableMem_threshold',
+    'FreeStorageSpace': 'freeStorage_threhsold', 'cpuSurplus': 'cpuSurplus_threshold',
+    'BurstBalance': 'burstBalance_threshold', 'ebsIOBalance': 'ebsIOBalance_threshold',
+    'ebsByteBalance': 'ebsByteBalance_threshold',
+}
+
+
+def values(field):
+    # Just below, at and just above the threshold of a field
+    if field in field_values:
+        return field_values[field]
+    threshold = config[threshold_keys[field]]
+    step = abs(threshold) / 2 or 1
+    return [threshold - step, threshold, threshold + step]
+
+
+def near_thresholds(ladder, busy):
+    # Every field at each of its values, and every two fields at once
+    records = []
+    fields = [field for name, field, check in ladder]
+    for first, second in itertools.combinations(fields, 2):
+        for first_value, second_value in itertools.product(values(first), values(second)):
+            records.append(dict(busy, **{first: first_value, second: second_value}))
+    return records
+
+
+@pytest.mark.parametrize('resource_type, ladder, busy', [('EC2', ec2_ladder, ec2_busy), ('RDS', rds_ladder, rds_busy)])
+def test_rules_match_the_old_ladders(resource_type, ladder, busy):
+    records = [busy] + near_thresholds(ladder, busy)
+    matched = match_rules(resource_type, records)
+
+    for record, names in zip(records, matched):
+        expected = tuple(name for name, field, check in ladder if check(record[field]))
+        # The same resources are orphaned, and every matching rule is named
+        assert bool(names) == bool(expected), record
+        assert names == expected, record
+
+    assert matched[0] == ()
+    assert any(len(names) == 2 for names in matched)
+
+
+def test_eip_run_imports_no_numpy():
+    # A fresh interpreter, since this one has numpy loaded already
+    script = (
+        "import sys\n"
+        "from identify_orphaned_resources import load_detectors\n"
+        "from records import orphan_record\n"
+        "import exporter, result_sink\n"
+        "load_detectors(['EIP'])\n"
+        "result_sink.orphan_row(orphan_record('EIP', 'eipalloc-1', {}))\n"
+        "print(sorted(name for name in ('numpy', 'pandas', 'xlsxwriter') if name in sys.modules))\n"
+    )
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', script], cwd=repository, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == '[]'
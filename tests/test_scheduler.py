@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import pytest
+from scheduler import Scheduler, start_trigger_server
+
+
+class Recorder:
+    # A run function recording every run and how many ran at once per
+    # detector; runs of the detectors in hold block until released
+
+    def __init__(self, hold=()):
+        self.runs = []
+        self.active = dict()
+        self.overlaps = 0
+        self.hold = set(hold)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self, detectors):
+        name, = detectors
+        with self.lock:
+            self.runs.append(name)
+            self.active[name] = self.active.get(name, 0) + 1
+            if self.active[name] > 1:
+                self.overlaps += 1
+        if name in self.hold:
+            self.started.set()
+            self.release.wait(5)
+        with self.lock:
+            self.active[name] -= 1
+
+
+def start(scheduler):
+    thread = threading.Thread(target=scheduler.run_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not met in {}s'.format(timeout))
+        time.sleep(0.01)
+
+
+def test_detectors_run_on_their_own_intervals():
+    recorder = Recorder()
+    scheduler = Scheduler({'EIP': None, 'EC2': None}, recorder, {'EIP': {'interval': 0.1}}, default_interval=3600)
+    start(scheduler)
+
+    wait_for(lambda: recorder.runs.count('EIP') >= 3)
+    assert recorder.runs.count('EC2') == 1
+
+
+def test_trigger_during_a_run_runs_again_afterwards():
+    recorder = Recorder(hold={'EC2'})
+    scheduler = Scheduler({'EC2': None}, recorder, {}, default_interval=3600)
+    start(scheduler)
+    assert recorder.started.wait(5)
+
+    scheduler.trigger(['EC2'])
+    scheduler.trigger(['EC2'])
+    assert scheduler.status()['EC2']['running']
+    recorder.release.set()
+
+    # Both triggers fold into one more run, never alongside the first
+    wait_for(lambda: len(recorder.runs) == 2)
+    time.sleep(0.1)
+    assert recorder.runs == ['EC2', 'EC2']
+    assert recorder.overlaps == 0
+
+
+def test_unknown_detector_is_rejected():
+    scheduler = Scheduler({'EC2': None}, Recorder(), {})
+    with pytest.raises(KeyError):
+        scheduler.trigger(['S3'])
+
+
+def test_trigger_server_listens_on_localhost():
+    recorder = Recorder()
+    scheduler = Scheduler({'EC2': None}, recorder, {}, default_interval=3600)
+    server = start_trigger_server(scheduler, 0)
+    try:
+        host, port = server.server_address
+        assert host == '127.0.0.1'
+
+        request = urllib.request.Request('http://127.0.0.1:{}/scan/EC2'.format(port), method='POST')
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 202
+            assert json.load(response) == {'triggered': ['EC2']}
+
+        request = urllib.request.Request('http://127.0.0.1:{}/scan/S3'.format(port), method='POST')
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
@@ -1,201 +1,137 @@
-import boto3
-import datetime
-import os
-import yaml
-from add_to_csv import add_to_csv
-from prometheus_client import start_http_server, Gauge
+from clients import get_client
+from config import load_config
+from records import orphan_record
+from result_sink import write_orphans
+from inventory import iter_volume_pages
+from metric_data import metric_stat, first_value
+from metric_history import record_history
+from query_planner import MetricPlanner
+from scan_state import split_changed, record_verdicts
 
 
-os.environ['AWS_PROFILE'] = 'demo-nid'
-
 # Load the config file
-with open('config.yml', 'r') as config_file:
-    config = yaml.safe_load(config_file)
+config = load_config()
 
 region_name = config['region_name']
 threshold1 = config['threshold1']
 threshold2 = config['threshold2']
 
-cloudwatch_client = boto3.client('cloudwatch', region_name = region_name)
-orphan_volumes = set()
-ec2_client = boto3.client('ec2', region_name = region_name)
-
-
-def get_volume_name(volume_id, ec2_client):
-    ec2_client = boto3.client('ec2')
-    
-    response = ec2_client.describe_volumes(VolumeIds=[volume_id])
-    
-    if 'Volumes' in response and len(response['Volumes']) > 0:
-        volume = response['Volumes'][0]
-        if 'Tags' in volume:
-            for tag in volume['Tags']:
-                if tag['Key'] == 'Name':
-                    return tag['Value']
-    
-    return None
 
-def get_volume_attachment_date(volume_id,ec2_client ):
-    
-    response = ec2_client.describe_volumes(VolumeIds=[volume_id])
-    
-    if 'Volumes' in response and len(response['Volumes']) > 0:
-        volume = response['Volumes'][0]
-        if 'Attachments' in volume and len(volume['Attachments']) > 0:
-            attachments = volume['Attachments']
-            # Sort attachments by 'AttachTime' in descending order
-            sorted_attachments = sorted(attachments, key=lambda x: x['AttachTime'], reverse=True)
-            last_attachment = sorted_attachments[0]
-            return last_attachment['AttachTime']
-    
+def get_volume_name(volume):
+    for tag in volume.get('Tags', []):
+        if tag['Key'] == 'Name':
+            return tag['Value']
+
     return None
 
-def get_volume_metrics(volume_id, start_time, end_time):
-    cloudwatch = boto3.client('cloudwatch')
-
-    # Get ReadOps
-    response = cloudwatch.get_metric_statistics(
-        Namespace='AWS/EBS',
-        MetricName='VolumeReadOps',
-        Dimensions=[
-            {
-                'Name': 'VolumeId',
-                'Value': volume_id
-            },
-        ],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=3600,
-        Statistics=['Sum']
-    )
-    read_ops = response['Datapoints'][0]['Sum'] if response['Datapoints'] else 0
-
-    # Get Write Ops
-    response = cloudwatch.get_metric_statistics(
-        Namespace='AWS/EBS',
-        MetricName='VolumeWriteOps',
-        Dimensions=[
-            {
-                'Name': 'VolumeId',
-                'Value': volume_id
-            },
-        ],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=3600,
-        Statistics=['Sum']
-    )
-    write_ops = response['Datapoints'][0]['Sum'] if response['Datapoints'] else 0
-
-    # Get Idle Time
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/EBS',
-        MetricName='VolumeIdleTime',
-        Dimensions=[{'Name': 'VolumeId', 'Value': volume_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=86400,  # 1 day
-        Statistics=['Average'],
-        Unit='Seconds'
-    )
-
-    datapoints = response['Datapoints']
-
-    if datapoints:
-        average_idle_time = datapoints[0]['Average']
-    else:
-        average_idle_time = 0
-    
-    #  Get Burst Balance
-    response = cloudwatch_client.get_metric_statistics(
-        Namespace='AWS/EBS',
-        MetricName='BurstBalance',
-        Dimensions=[{'Name': 'VolumeId', 'Value': volume_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=86400,  # 1 day
-        Statistics=['Average']
-    )
-    datapoints = response['Datapoints']
-
-    if datapoints:
-        average_burst_balance = datapoints[0]['Average']
-    else:
-        average_burst_balance = 0
-    
-    # Get in_use info
-    if average_idle_time > threshold1 and average_burst_balance > threshold2:
-        inuse = True
-    else:
-        inuse =  False
+def get_volume_attachment_date(volume):
+    if 'Attachments' in volume and len(volume['Attachments']) > 0:
+        attachments = volume['Attachments']
+        # Sort attachments by 'AttachTime' in descending order
+        sorted_attachments = sorted(attachments, key=lambda x: x['AttachTime'], reverse=True)
+        last_attachment = sorted_attachments[0]
+        return last_attachment['AttachTime']
 
-    volume_metrics = dict()
-    volume_metrics['VolumeID'] = volume_id
-    volume_metrics['ReadOps'] = read_ops
-    volume_metrics['WriteOps'] = write_ops
-    volume_metrics['IdleTime'] =  average_idle_time
-    volume_metrics['BurstBalance'] = average_burst_balance
+    return None
 
-    return volume_metrics
+# (metrics dict key, CloudWatch metric name, statistic, period, unit)
+volume_metric_queries = [
+    ('ReadOps', 'VolumeReadOps', 'Sum', 3600, None),
+    ('WriteOps', 'VolumeWriteOps', 'Sum', 3600, None),
+    ('IdleTime', 'VolumeIdleTime', 'Average', 86400, 'Seconds'),
+    ('BurstBalance', 'BurstBalance', 'Average', 86400, None),
+]
+
+def build_volume_queries(volume_ids):
+    queries = dict()
+    for volume_id in volume_ids:
+        for key, metric_name, stat, period, unit in volume_metric_queries:
+            queries[(volume_id, key)] = metric_stat('AWS/EBS', metric_name, 'VolumeId', volume_id, stat, period, unit)
+    return queries
+
+def build_volume_metrics(volume_ids, results):
+    metrics = dict()
+    for volume_id in volume_ids:
+        volume_metrics = dict()
+        volume_metrics['VolumeID'] = volume_id
+        for key, metric_name, stat, period, unit in volume_metric_queries:
+            volume_metrics[key] = first_value(results[(volume_id, key)])
+
+        metrics[volume_id] = volume_metrics
+
+    return metrics
+
+def get_volume_metrics(volume_ids, planner=None):
+    # Fetch every metric of every volume through the scan's query planner
+    planner = planner or MetricPlanner(get_client('cloudwatch', region=region_name))
+    results = planner.get(build_volume_queries(volume_ids))
+    return build_volume_metrics(volume_ids, results)
+
+def detect_orphan_volumes(snapshot=None):
+    print("\nFinding orphan Volumes...")
+    orphan_volumes = set()
 
-orphaned_volume_metric = Gauge(
-            'orphaned_volumes',
-            'Number of orphaned volumes',
-            ['volume_id', 'ReadOps','WriteOps','IdleTime', 'BurstBalance']
-            )    
+    # Reuse the scan snapshot when there is one, otherwise stream the volumes
+    if snapshot:
+        volume_pages = snapshot.pages('volumes')
+        planner = snapshot.metric_planner()
+    else:
+        volume_pages = iter_volume_pages(get_client('ec2', region=region_name))
+        planner = MetricPlanner(get_client('cloudwatch', region=region_name))
 
-def detect_orphan_volumes():
-    print("\nFinding orphan Volumes...")
+    # Walk the volumes page by page
+    for volumes in volume_pages:
+        page_orphans = detect_orphan_volume_page(volumes, planner)
+        write_orphans(page_orphans)
+        orphan_volumes.update(page_orphans)
 
-    # Retrieve information about all volumes
-    response = ec2_client.describe_volumes()
-    volumes = response['Volumes']
+    return orphan_volumes
 
+def detect_orphan_volume_page(volumes, planner=None):
+    # Only new, changed or stale volumes are evaluated in incremental mode
+    volumes, known_orphans = split_changed('Volume', volumes)
+    all_metrics = get_volume_metrics([volume['VolumeId'] for volume in volumes], planner)
+    orphan_volumes = evaluate_volume_page(volumes, all_metrics)
+    record_verdicts('Volume', volumes, orphan_volumes)
+    return orphan_volumes.union(known_orphans)
 
+def evaluate_volume_page(volumes, all_metrics):
+    orphan_volumes = set()
+    record_history('VOLUME', all_metrics)
 
     for volume in volumes:
         volume_id = volume['VolumeId']
-        end_time = datetime.datetime.utcnow()
-        start_time = end_time - datetime.timedelta(days=1)
 
-        volume_metrics = get_volume_metrics(volume_id, start_time, end_time)
-        volume_metrics['Attachment-date'] = get_volume_attachment_date(volume_id,ec2_client)
+        volume_metrics = all_metrics[volume_id]
+        volume_metrics['Attachment-date'] = get_volume_attachment_date(volume)
 
         average_idle_time = volume_metrics['IdleTime']
         average_burst_balance = volume_metrics['BurstBalance']
 
+        reasons = []
+
         # Check if the volume is not attached to any instance
         if 'Attachments' not in volume or len(volume['Attachments']) == 0:
             # Additional checks for orphan volumes
             if volume.get('State', '') != 'in-use':
-                orphan_volumes.add(('VOLUME', volume_id, volume_metrics.values()))
-                orphaned_volume_metric.labels(volume_id=volume_id,ReadOps=volume_metrics['ReadOps'],WriteOps=volume_metrics['WriteOps'],IdleTime=volume_metrics['IdleTime'], BurstBalance=volume_metrics['BurstBalance']).set(1)
-
+                reasons.append('unattached')
 
             elif volume.get('State', '') == 'in-use' and not volume.get('Tags'):
-                orphan_volumes.add(('VOLUME', volume_id, volume_metrics.values()))
-                orphaned_volume_metric.labels(volume_id=volume_id,ReadOps=volume_metrics['ReadOps'],WriteOps=volume_metrics['WriteOps'],IdleTime=volume_metrics['IdleTime'], BurstBalance=volume_metrics['BurstBalance']).set(1)
-
+                reasons.append('untagged')
 
             elif volume.get('State', '') == 'in-use' and all(tag['Key'] != 'Name' for tag in volume.get('Tags', [])):
-                orphan_volumes.add(('VOLUME', volume_id, volume_metrics.values()))
-                orphaned_volume_metric.labels(volume_id=volume_id,ReadOps=volume_metrics['ReadOps'],WriteOps=volume_metrics['WriteOps'],IdleTime=volume_metrics['IdleTime'], BurstBalance=volume_metrics['BurstBalance']).set(1)
-
+                reasons.append('unnamed')
 
             elif average_idle_time < threshold1 or average_burst_balance <= threshold2:
-                orphan_volumes.add(('VOLUME', volume_id, volume_metrics.values()))
-                orphaned_volume_metric.labels(volume_id=volume_id,ReadOps=volume_metrics['ReadOps'],WriteOps=volume_metrics['WriteOps'],IdleTime=volume_metrics['IdleTime'], BurstBalance=volume_metrics['BurstBalance']).set(1)
+                reasons.append('idle')
 
-        
         # Check if the volume is attached to a stopped instance
-        for attachment in volume.get('Attachments', []):
-            if attachment.get('State', '') == 'stopped':
-                orphan_volumes.add(('VOLUME', volume_id, volume_metrics.values()))
-                orphaned_volume_metric.labels(volume_id=volume_id,ReadOps=volume_metrics['ReadOps'],WriteOps=volume_metrics['WriteOps'],IdleTime=volume_metrics['IdleTime'], BurstBalance=volume_metrics['BurstBalance']).set(1)
+        if any(attachment.get('State', '') == 'stopped' for attachment in volume.get('Attachments', [])):
+            reasons.append('attached_to_stopped_instance')
 
+        if reasons:
+            orphan_volumes.add(orphan_record('VOLUME', volume_id, volume_metrics, reasons))
 
-        
-    add_to_csv(orphan_volumes)
     return orphan_volumes
 
 